@@ -13,22 +13,35 @@
 # limitations under the License.
 
 import json
+import time
+import random
+import hashlib
+import datetime
 import os.path
 import logging
-import time
-
-import requests
-from bleach import clean
-from markdown import markdown
-from webhelpers.text import truncate
+import threading
+from email.utils import parsedate_tz, mktime_tz
+from functools import partial
+from urllib import quote
 
 import ckan.model as model
+import ckan.plugins.toolkit as tk
 from ckan.logic import get_action
 from ckan.lib.munge import munge_name
 
-from ckanext.datadotworld.model import States
+from ckanext.datadotworld.model import States, ValidationStates
 from ckanext.datadotworld.model.extras import Extras
+from ckanext.datadotworld.model.sync_log import SyncLog
 from ckanext.datadotworld import __version__
+from ckanext.datadotworld import ratelimit
+from ckanext.datadotworld import metrics
+# registers session hook that maintains state counters
+from ckanext.datadotworld import counters
+from ckanext.datadotworld.helpers import config_int, config_float
+from ckanext.datadotworld.helpers import (
+    DATADOTWORLD_ROOT, datadotworld_link, datadotworld_creds)
+from ckanext.datadotworld.jobs import compat_enqueue
+from ckanext.datadotworld.cache import LRUCache
 from pylons import config
 import re
 from ckan.lib.helpers import url_for
@@ -48,27 +61,55 @@ licenses = {
     # 'CC BY-NC-SA',
 }
 
-def compat_enqueue(name, fn, args=None):
-    u'''
-    Enqueue a background job using Celery or RQ.
-    '''
+_sessions = {}
+_sessions_lock = threading.Lock()
+_loaded_config = {}
+
+_tagname_match = re.compile('^[a-z0-9]+( [a-z0-9]+)*$')
+_tags_cache = LRUCache(10000)
+_not_cached = object()
+_payload_builder = None
+
+def _config_signature(config_abs_path):
+    stat = os.stat(config_abs_path)
+    return stat.st_mtime, stat.st_size
+
+
+def _environment_file():
+    """Path of config file used by already loaded CKAN environment.
+    """
     try:
-        # Try to use RQ
-        from ckan.lib.jobs import enqueue
-        enqueue(fn, args=args)
-    except ImportError:
-        # Fallback to Celery
-        from ckan.lib.celery_app import celery
-        celery.send_task(name, args=args)
+        if 'pylons.app_globals' in config:
+            return config.get('__file__')
+    except (AttributeError, TypeError):
+        # no config registered for this process yet
+        pass
+
 
 def load_config(ckan_ini_filepath):
-    import os
+    """Load CKAN environment once per worker process.
+
+    Environment is cached by config path and reloaded only when another
+    config is requested or config file was modified since last load.
+    """
     import paste.deploy
     config_abs_path = os.path.abspath(ckan_ini_filepath)
+    signature = _config_signature(config_abs_path)
+    if _loaded_config.get(config_abs_path) == signature:
+        return
+    if not _loaded_config and _environment_file() == config_abs_path:
+        # environment was loaded by worker itself(`paster jobs worker`)
+        _loaded_config[config_abs_path] = signature
+        return
+
     conf = paste.deploy.appconfig('config:' + config_abs_path)
     import ckan
     ckan.config.environment.load_environment(conf.global_conf,
                                              conf.local_conf)
+    global _payload_builder
+    _payload_builder = None
+    _loaded_config.clear()
+    _loaded_config[config_abs_path] = signature
 
 
 def register_translator():
@@ -78,7 +119,7 @@ def register_translator():
     from paste.registry import Registry
     from pylons import translator
     from ckan.lib.cli import MockTranslator
-    if 'registery' not in globals():
+    if 'registry' not in globals():
         global registry
         registry = Registry()
         registry.prepare()
@@ -88,10 +129,149 @@ def register_translator():
         translator_obj = MockTranslator()
         registry.register(translator, translator_obj)
         
-def syncronize(id, ckan_ini_filepath, attempt=0):
+def _sync_finished(enqueued):
+    if enqueued is not None:
+        metrics.observe(
+            'datadotworld_sync_seconds', max(0, time.time() - enqueued))
+
+
+def syncronize(id, ckan_ini_filepath, attempt=0, force=False, enqueued=None):
+    load_config(ckan_ini_filepath)
+    register_translator()
+    try:
+        if notify(id, attempt, force, enqueued):
+            _sync_finished(enqueued)
+    finally:
+        _release_due_retries()
+        metrics.flush()
+
+
+def syncronize_batch(ids, ckan_ini_filepath, force=False, enqueued=None):
+    """Sync list of packages one by one inside single job.
+    """
+    load_config(ckan_ini_filepath)
+    register_translator()
+    try:
+        for id in ids:
+            try:
+                synced = notify(id, force=force, enqueued=enqueued)
+            except Exception as e:
+                model.Session.rollback()
+                log.error('[{0}] Sync failed: {1}'.format(id, e))
+            else:
+                if synced:
+                    _sync_finished(enqueued)
+    finally:
+        _release_due_retries()
+        metrics.flush()
+
+
+def enqueue_batches(ids, force=False):
+    """Split package ids into chunks and enqueue batch job for each.
+
+    Chunk size is controlled by `ckan.datadotworld.batch_size`.
+    """
+    batch_size = max(1, config_int('ckan.datadotworld.batch_size', 50))
+    ckan_ini_filepath = os.path.abspath(config['__file__'])
+    batch = []
+    amount = 0
+    for id in ids:
+        batch.append(id)
+        if len(batch) < batch_size:
+            continue
+        compat_enqueue(
+            'datadotworld.syncronize_batch',
+            syncronize_batch,
+            args=[batch, ckan_ini_filepath, force, time.time()])
+        amount += 1
+        batch = []
+    if batch:
+        compat_enqueue(
+            'datadotworld.syncronize_batch',
+            syncronize_batch,
+            args=[batch, ckan_ini_filepath, force, time.time()])
+        amount += 1
+    return amount
+
+
+def syncronize_org(id):
+    """Enqueue forced sync of all packages of organization.
+
+    Synced packages are marked as pending until their jobs finish.
+    """
+    extras = model.Session.query(Extras).join(model.Package).filter(
+        model.Package.owner_org == id)
+    for item in extras:
+        item.state = States.pending
+    model.Session.commit()
+
+    # credentials may point to another data.world account now, so local
+    # payload fingerprints cannot be trusted - force remote dirty check
+    packages = model.Session.query(model.Package.id).filter_by(
+        owner_org=id
+    )
+    enqueue_batches((pkg.id for pkg in packages), force=True)
+
+
+def check_credentials(credentials):
+    """Check owner and key of credentials against data.world.
+
+    Result is stored on credentials, successful check is remembered by
+    fingerprint of owner and key, so unchanged credentials are not
+    checked again. Returns validation state.
+    """
+    import requests
+
+    if credentials.is_validated:
+        return ValidationStates.valid
+    fingerprint = credentials.fingerprint(credentials.owner, credentials.key)
+    timeout = config_float('ckan.datadotworld.check_timeout', 10)
+    client = API(credentials.owner, credentials.key)
+    try:
+        valid = client.check_credentials(timeout=timeout)
+    except (requests.RequestException, ratelimit.RateLimitTimeout) as e:
+        state, message = ValidationStates.error, str(e)
+    else:
+        if valid:
+            state, message = ValidationStates.valid, None
+        else:
+            state, message = ValidationStates.invalid, 'Incorrect key'
+
+    credentials.validation_state = state
+    credentials.validation_message = message
+    credentials.validated_at = datetime.datetime.utcnow()
+    credentials.validated_hash = (
+        fingerprint if state == ValidationStates.valid else None)
+    return state
+
+
+def validate_credentials(org_id, ckan_ini_filepath):
+    """Background check of organization credentials.
+
+    Sync of organization starts once credentials are confirmed.
+    """
     load_config(ckan_ini_filepath)
     register_translator()
-    notify(id, attempt)
+    org = model.Group.get(org_id)
+    credentials = org and org.datadotworld_credentials
+    if credentials is None:
+        return
+    checked = (credentials.owner, credentials.key)
+    state = check_credentials(credentials)
+    result = dict(
+        (name, getattr(credentials, name)) for name in (
+            'validation_state', 'validation_message', 'validated_at',
+            'validated_hash'))
+    # credentials may be changed while check was in progress. Their own
+    # check is enqueued then, so result of this one is dropped
+    model.Session.rollback()
+    if (credentials.owner, credentials.key) != checked:
+        return
+    for name, value in result.items():
+        setattr(credentials, name, value)
+    model.Session.commit()
+    if state == ValidationStates.valid and credentials.integration:
+        syncronize_org(org_id)
 
 
 def get_context():
@@ -105,41 +285,79 @@ def dataworld_name(title):
     )
 
 
+def _normalize_tag(name):
+    """Convert CKAN tag name to data.world tag or None if it's invalid.
+    """
+    normalized = _tags_cache.get(name, _not_cached)
+    if normalized is not _not_cached:
+        return normalized
+    normalized = None
+    if 1 < len(name) <= 25:
+        candidate = name.lower().replace('-', ' ').replace('_', ' ')
+        if _tagname_match.match(candidate):
+            normalized = candidate
+    _tags_cache.set(name, normalized)
+    return normalized
+
+
 def datadotworld_tags_name_normalize(tags_list):
-    tags_list = [tag['name'].lower().replace('-', ' ').replace('_', ' ')
-                 for tag in tags_list if (len(tag['name']) > 1 and
-                                          len(tag['name']) <= 25)]
-    tagname_match = re.compile('^[a-z0-9]+( [a-z0-9]+)*$')
-    tags_list = [tag for tag in tags_list if tagname_match.match(tag)]
-    tags_list = list(set(tags_list))
-    return tags_list
-
-
-def _get_creds_if_must_sync(pkg_dict):
-    owner_org = pkg_dict.get('owner_org')
-    org = model.Group.get(owner_org)
-    if org is None:
-        return
-    credentials = org.datadotworld_credentials
+    tags = set()
+    for tag in tags_list:
+        normalized = _normalize_tag(tag['name'])
+        if normalized is not None:
+            tags.add(normalized)
+    return list(tags)
+
+
+def tags_cache_info():
+    """Hits and misses of tag normalization cache.
+    """
+    return _tags_cache.info()
+
+
+def _get_creds_if_must_sync(pkg_dict, fresh=False):
+    credentials = datadotworld_creds(pkg_dict.get('owner_org'), fresh)
     if credentials is None or not credentials.integration:
         return
     return credentials
 
 
-def notify(pkg_id, attempt=0):
+def _get_api_if_must_sync(pkg_id, fresh=False):
+    """Build API client for package that must be synced.
+
+    Cached credentials are used unless `fresh` is set.
+    """
     pkg_dict = get_action('package_show')(get_context(), {'id': pkg_id})
     if pkg_dict.get('type', 'dataset') != 'dataset':
-        return False
-    credentials = _get_creds_if_must_sync(pkg_dict)
+        return None, pkg_dict
+    credentials = _get_creds_if_must_sync(pkg_dict, fresh)
     if not credentials:
-        return False
+        return None, pkg_dict
     if pkg_dict.get('state') == 'draft':
+        return None, pkg_dict
+    return API(credentials.owner, credentials.key), pkg_dict
+
+
+def notify(pkg_id, attempt=0, force=False, enqueued=None):
+    # forced syncs follow credentials change, so cache is bypassed
+    api, pkg_dict = _get_api_if_must_sync(pkg_id, fresh=force)
+    if api is None:
         return False
-    api = API(credentials.owner, credentials.key)
-    api.sync(pkg_dict, attempt)
+    api.sync(pkg_dict, attempt, force=force, enqueued=enqueued)
     return True
 
 
+def notify_deferred(pkg_id, attempt=0, force=False):
+    """Same as `notify`, but returns `API.sync_deferred` result.
+
+    None is returned when package must not be synced.
+    """
+    api, pkg_dict = _get_api_if_must_sync(pkg_id, fresh=force)
+    if api is None:
+        return
+    return api.sync_deferred(pkg_dict, attempt, force=force)
+
+
 def _prepare_resource_url(res):
     """Convert list of resources to files_list for data.world.
     """
@@ -166,66 +384,333 @@ def _prepare_resource_url(res):
     description = res.get('description', '')
 
     if description:
-
+        from webhelpers.text import truncate
         prepared_data['description'] = truncate(
             description, 120, whole_word=True)
 
     return prepared_data
 
-def _delay_request():
-    request_delay = config.get(
-        'ckan.datadotworld.request_delay', 1)
+def _make_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    pool_connections = config_int('ckan.datadotworld.pool_connections', 10)
+    pool_maxsize = config_int('ckan.datadotworld.pool_maxsize', 10)
+    keep_alive = tk.asbool(config.get('ckan.datadotworld.keep_alive', True))
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(owner, key):
+    """Get pooled HTTP session for data.world credentials.
+
+    Sessions live on module level, so every API instance in the same
+    process reuses open connections. RQ worker forks a child for every
+    job, so there connections are reused only within one job; batch jobs
+    and `--workers` commands benefit the most.
+    """
+    with _sessions_lock:
+        session = _sessions.get((owner, key))
+        if session is None:
+            session = _sessions[(owner, key)] = _make_session()
+    return session
+
+
+def payload_hash(data):
+    """Stable fingerprint of formatted data.world payload.
+    """
+    normalized = dict(data, tags=sorted(data.get('tags') or []))
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True)).hexdigest()
+
+
+def _remember_payload(extras, data):
+    """Store payload that was synced as baseline for next update.
+    """
+    extras.payload_hash = payload_hash(data)
+    extras.payload = json.dumps(data)
+
+
+def _forget_payload(extras):
+    extras.payload_hash = None
+    extras.payload = None
+
+
+def _baseline(extras):
+    """Last synced payload or None if it is unknown.
+    """
+    if not extras.payload:
+        return
     try:
-        request_delay = float(request_delay)
-    except Exception as e:
-        return False
-    if (request_delay > 0):
-        time.sleep(request_delay)
+        return json.loads(extras.payload)
+    except ValueError:
+        return
 
-    return True
 
+def _files_diff(files, old_files):
+    """Find files added or changed and names of files removed.
 
-def _repeat_request(pkg_id, attempt):
-    attempt += 1
-    max_attempt = config.get(
-        'ckan.datadotworld.max_request_attempt', 10)
+    Returns None when file names are not unique, as files cannot be
+    matched then.
+    """
+    new_mapping = dict((f['name'], f) for f in files)
+    old_mapping = dict((f['name'], f) for f in old_files)
+    if len(new_mapping) != len(files) or len(old_mapping) != len(old_files):
+        return
+    changed = [f for f in files if old_mapping.get(f['name']) != f]
+    removed = [name for name in old_mapping if name not in new_mapping]
+    return changed, removed
+
+
+def _payload_diff(data, baseline):
+    """Fields of payload that differ from baseline.
+    """
+    changes = {}
+    for key, value in data.items():
+        old_value = baseline.get(key)
+        if key == 'tags':
+            if sorted(value) == sorted(old_value or []):
+                continue
+        elif value == old_value:
+            continue
+        changes[key] = value
+    return changes
+
+
+def _truncate_text(value, length):
+    if len(value) <= length:
+        return value
+    return value[:length] + '...'
+
+
+def _response_text(res):
+    content = res.content or ''
+    if isinstance(content, str):
+        content = content.decode('utf-8', 'replace')
+    return content
+
+
+def _result_summary(content):
+    """Compact version of data.world response for `Extras.message`.
+
+    Only first fields of JSON object are kept and long values are
+    truncated. Other responses are truncated as plain text.
+    """
+    field_length = config_int('ckan.datadotworld.summary_field_length', 200)
     try:
-        max_attempt = int(max_attempt) - 1
-    except Exception as e:
-        log.info('Wrong variable format for max_request_attempt.')
+        body = json.loads(content)
+    except (TypeError, ValueError):
+        body = None
+    if not isinstance(body, dict):
+        return _truncate_text(content, field_length)
+    summary = {}
+    for key in sorted(body)[:10]:
+        value = body[key]
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        if isinstance(value, basestring):
+            value = _truncate_text(value, field_length)
+        summary[key] = value
+    return json.dumps(summary)
+
+
+def _record_result(extras, action, res):
+    """Keep summary of response on extras and append it to sync log.
+    """
+    content = _response_text(res)
+    extras.message = _result_summary(content)
+    if not extras.package_id:
         return
+    now = datetime.datetime.utcnow()
+    duration = None
+    if extras.started_at:
+        delta = now - extras.started_at
+        duration = delta.days * 86400 + delta.seconds + (
+            delta.microseconds / 1e6)
+    message_length = config_int(
+        'ckan.datadotworld.sync_log_message_length', 1000)
+    model.Session.add(SyncLog(
+        package_id=extras.package_id, created=now, action=action,
+        status=res.status_code, duration=duration,
+        message=_truncate_text(content, message_length)))
+
+
+def prune_sync_log(days=None):
+    """Delete sync log entries older than retention period.
+
+    Returns number of deleted entries.
+    """
+    if days is None:
+        days = config_int('ckan.datadotworld.sync_log_retention_days', 30)
+    border = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    amount = model.Session.query(SyncLog).filter(
+        SyncLog.created < border).delete(synchronize_session=False)
+    model.Session.commit()
+    return amount
+
+
+def _retry_delay(res, attempt):
+    """Seconds to wait before repeating request rejected with 429.
+
+    `Retry-After` header is honoured when present, otherwise exponential
+    backoff with full jitter is used.
+    """
+    retry_after = (getattr(res, 'headers', None) or {}).get('Retry-After')
+    if retry_after:
+        try:
+            return max(0, int(retry_after))
+        except ValueError:
+            parsed = parsedate_tz(retry_after)
+            if parsed:
+                return max(0, mktime_tz(parsed) - time.time())
+    base = config_float('ckan.datadotworld.retry_base_delay', 2)
+    cap = config_float('ckan.datadotworld.retry_max_delay', 600)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _repeat_request(extras, res, attempt):
+    """Schedule another attempt to sync dataset.
+
+    Retry is stored on extras row and released once it is due by
+    `paster datadotworld release_retries` or at the end of another sync
+    job. Dataset is pending until then.
+    """
+    attempt += 1
+    max_attempt = config_int('ckan.datadotworld.max_request_attempt', 10) - 1
     if attempt > max_attempt:
-        log.info('Max request attempt ({0}) achieved for {1}.'.format(max_attempt, pkg_id))
+        log.info('Max request attempt ({0}) achieved for {1}.'.format(
+            max_attempt, extras.id))
+        extras.state = States.failed
+        extras.next_attempt = None
         return
+    delay = _retry_delay(res, attempt - 1)
+    metrics.inc('datadotworld_retries_total')
+    extras.state = States.pending
+    extras.attempt = attempt
+    extras.next_attempt = datetime.datetime.utcnow() + datetime.timedelta(
+        seconds=delay)
+    log.info('[{0}] Attempt #{1} scheduled in {2:.1f} seconds'.format(
+        extras.id, attempt, delay))
+
+
+def release_retries():
+    """Enqueue sync jobs for all retries that are due.
+
+    Returns number of released jobs.
+    """
+    now = datetime.datetime.utcnow()
+    due = model.Session.query(Extras).filter(
+        Extras.next_attempt <= now).with_for_update().all()
+    jobs = []
+    for extras in due:
+        jobs.append((extras.package_id, extras.attempt or 0))
+        extras.next_attempt = None
+    model.Session.commit()
+
     ckan_ini_filepath = os.path.abspath(config['__file__'])
-    compat_enqueue(
-        'datadotworld.syncronize',
-        syncronize,
-        args=[pkg_id, ckan_ini_filepath, attempt])
+    for pkg_id, attempt in jobs:
+        compat_enqueue(
+            'datadotworld.syncronize',
+            syncronize,
+            args=[pkg_id, ckan_ini_filepath, attempt, False, time.time()])
+    return len(jobs)
 
-def dataset_footnote(pkg_dict):
-    dataset_url = url_for(controller='package', action='read', id=pkg_dict.get('id'), qualified=True)
-    source_str = 'Source: {0}'.format(dataset_url)
-    dataset_date = date_str_to_datetime(pkg_dict.get('metadata_modified'))
-    date_str = 'Last updated at {0} : {1}'.format(
-        url_for(controller='home', action='index', qualified=True), 
-        render_datetime(dataset_date, '%Y-%m-%d'))
-    return '\n\n{0}  \r\n{1}'.format(source_str, date_str)
+
+def _release_due_retries():
+    """Release due retries from worker, so they do not depend on cron only.
+    """
+    try:
+        released = release_retries()
+    except Exception as e:
+        model.Session.rollback()
+        log.warn('Retries are not released: {0}'.format(e))
+        return
+    if released:
+        log.info('Released {0} due retries'.format(released))
+
+
+class PayloadBuilder(object):
+    """Builds data.world payloads from CKAN package dicts.
+
+    Routing lookups and config parsing are done once, when builder is
+    created, and single builder is shared by all jobs processed by a
+    worker(see `get_payload_builder`).
+    """
+    id_placeholder = 'datadotworld-package-id'
+    _plain_id = re.compile('^[A-Za-z0-9_-]+$')
+    _iso_date = re.compile('^\d{4}-\d{2}-\d{2}T')
+
+    def __init__(self):
+        self.home_url = url_for(
+            controller='home', action='index', qualified=True)
+        self.dataset_url = url_for(
+            controller='package', action='read', id=self.id_placeholder,
+            qualified=True)
+        self.licenses = licenses
+        timezone = config.get('ckan.display_timezone') or ''
+        self.utc_dates = timezone.lower() in ('', 'utc')
+
+    def _dataset_url(self, id):
+        if id and self._plain_id.match(id):
+            return self.dataset_url.replace(self.id_placeholder, id)
+        return url_for(
+            controller='package', action='read', id=id, qualified=True)
+
+    def _date(self, metadata_modified):
+        if (self.utc_dates and isinstance(metadata_modified, basestring) and
+                self._iso_date.match(metadata_modified)):
+            return metadata_modified[:10]
+        dataset_date = date_str_to_datetime(metadata_modified)
+        return render_datetime(dataset_date, '%Y-%m-%d')
+
+    def footnote(self, pkg_dict):
+        source_str = 'Source: {0}'.format(
+            self._dataset_url(pkg_dict.get('id')))
+        date_str = 'Last updated at {0} : {1}'.format(
+            self.home_url, self._date(pkg_dict.get('metadata_modified')))
+        return '\n\n{0}  \r\n{1}'.format(source_str, date_str)
+
+    def format_data(self, pkg_dict):
+        notes = pkg_dict.get('notes') or ''
+        notes += self.footnote(pkg_dict)
+        tags = datadotworld_tags_name_normalize(pkg_dict.get('tags', []))
+        data = dict(
+            title=pkg_dict['name'],
+            description=pkg_dict['title'],
+            summary=notes,
+            tags=tags,
+            license=self.licenses.get(pkg_dict.get('license_id'), 'Other'),
+            visibility='PRIVATE' if pkg_dict.get('private') else 'OPEN',
+            files=[
+                _prepare_resource_url(res)
+                for res in pkg_dict['resources']
+            ]
+        )
+
+        return data
 
 
+def get_payload_builder():
+    """Payload builder shared by all jobs of current worker.
+    """
+    global _payload_builder
+    if _payload_builder is None:
+        _payload_builder = PayloadBuilder()
+    return _payload_builder
+
 
 def dataset_footnote(pkg_dict):
-    dataset_url = url_for(controller='package', action='read', id=pkg_dict.get('id'), qualified=True)
-    source_str = 'Source: {0}'.format(dataset_url)
-    dataset_date = date_str_to_datetime(pkg_dict.get('metadata_modified'))
-    date_str = 'Last updated at {0} : {1}'.format(
-        url_for(controller='home', action='index', qualified=True), 
-        render_datetime(dataset_date, '%Y-%m-%d'))
-    return '\n\n{0}  \r\n{1}'.format(source_str, date_str)
+    return get_payload_builder().footnote(pkg_dict)
 
 
 class API:
-    root = 'https://data.world'
+    root = DATADOTWORLD_ROOT
     api_root = 'https://api.data.world/v0'
     api_create = api_root + '/datasets/{owner}'
     api_create_put = api_create + '/{id}'
@@ -236,32 +721,37 @@ class API:
     api_res_update = api_res_create + '/{file}'
     api_res_delete = api_res_create + '/{file}'
 
+    endpoints = (
+        'api_create', 'api_create_put', 'api_update', 'api_delete',
+        'api_res_create', 'api_res_sync', 'api_res_update', 'api_res_delete'
+    )
+
     auth = 'Bearer {key}'
     user_agent_header = 'ckanext-datadotworld/' + __version__
 
-    @classmethod
-    def generate_link(cls, owner, package=None):
-        """Create link to data.world dataset.
-        """
-        parts = [cls.root, owner]
-        if package:
-            parts.append(package)
-        return '/'.join(parts)
-
-    @staticmethod
-    def creds_from_id(org_id):
-        """Find data.world credentials by org id.
-        """
-        org = model.Group.get(org_id)
-        if not org:
-            return
-        return org.datadotworld_credentials
+    generate_link = staticmethod(datadotworld_link)
+    creds_from_id = staticmethod(datadotworld_creds)
 
     def __init__(self, owner, key):
         """Initialize client with credentials.
         """
         self.owner = owner
         self.key = key
+        api_root = config.get('ckan.datadotworld.api_root')
+        if api_root:
+            self._use_api_root(api_root.rstrip('/'))
+
+    def _use_api_root(self, api_root):
+        """Point all endpoints to another API root.
+        """
+        for name in self.endpoints:
+            template = getattr(API, name)
+            setattr(self, name, api_root + template[len(API.api_root):])
+        self.api_root = api_root
+
+    @property
+    def session(self):
+        return get_session(self.owner, self.key)
 
     def _default_headers(self):
         return {
@@ -270,49 +760,67 @@ class API:
             'User-Agent': self.user_agent_header
         }
 
-    def _get(self, url):
+    def _send(self, method, url, data=None, endpoint=None, timeout=None):
+        """Send request and record its metrics.
+
+        `endpoint` labels metrics of request and defaults to HTTP method.
+        `timeout` limits both waiting for rate limiter and the response.
+        """
+        endpoint = endpoint or method
+        kwargs = {'url': url, 'headers': self._default_headers()}
+        if timeout:
+            kwargs['timeout'] = timeout
+        if data is not None:
+            kwargs['data'] = json.dumps(data)
+            metrics.observe(
+                'datadotworld_payload_bytes', len(kwargs['data']),
+                endpoint=endpoint)
+        ratelimit.acquire(self.owner, timeout)
+        started = time.time()
+        try:
+            res = getattr(self.session, method)(**kwargs)
+        except Exception:
+            metrics.inc(
+                'datadotworld_requests_total',
+                endpoint=endpoint, status='error')
+            raise
+        metrics.observe(
+            'datadotworld_request_seconds', time.time() - started,
+            endpoint=endpoint)
+        metrics.inc(
+            'datadotworld_requests_total',
+            endpoint=endpoint, status=str(res.status_code))
+        if res.status_code == 429:
+            metrics.inc('datadotworld_rate_limited_total', endpoint=endpoint)
+        return res
+
+    def _get(self, url, endpoint=None, timeout=None):
         """Simple wrapper around GET request.
         """
-        headers = self._default_headers()
-        return requests.get(url=url, headers=headers)
+        return self._send('get', url, endpoint=endpoint, timeout=timeout)
 
-    def _post(self, url, data):
+    def _post(self, url, data, endpoint=None):
         """Simple wrapper around POST request.
         """
-        headers = self._default_headers()
-        return requests.post(url=url, data=json.dumps(data), headers=headers)
+        return self._send('post', url, data, endpoint)
 
-    def _put(self, url, data):
+    def _put(self, url, data, endpoint=None):
         """Simple wrapper around PUT request.
         """
-        headers = self._default_headers()
-        return requests.put(url=url, data=json.dumps(data), headers=headers)
+        return self._send('put', url, data, endpoint)
 
-    def _delete(self, url, data):
+    def _patch(self, url, data, endpoint=None):
+        """Simple wrapper around PATCH request.
+        """
+        return self._send('patch', url, data, endpoint)
+
+    def _delete(self, url, data, endpoint=None):
         """Simple wrapper around DELETE request.
         """
-        headers = self._default_headers()
-        return requests.delete(url=url, data=json.dumps(data), headers=headers)
+        return self._send('delete', url, data, endpoint)
 
     def _format_data(self, pkg_dict):
-        notes = pkg_dict.get('notes') or ''
-        footnote = dataset_footnote(pkg_dict)
-        notes += footnote
-        tags = datadotworld_tags_name_normalize(pkg_dict.get('tags', []))
-        data = dict(
-            title=pkg_dict['name'],
-            description=pkg_dict['title'],
-            summary=notes,
-            tags=list(set(tags)),
-            license=licenses.get(pkg_dict.get('license_id'), 'Other'),
-            visibility='PRIVATE' if pkg_dict.get('private') else 'OPEN',
-            files=[
-                _prepare_resource_url(res)
-                for res in pkg_dict['resources']
-            ]
-        )
-
-        return data
+        return get_payload_builder().format_data(pkg_dict)
 
     def _is_dict_changed(self, new_data, old_data):
         for key, value in new_data.items():
@@ -322,46 +830,124 @@ class API:
 
     def _create_request(self, data, id):
         url = self.api_create_put.format(owner=self.owner, id=id)
-        res = self._put(url, data)
+        res = self._put(url, data, 'create')
         if res.status_code == 200:
             log.info('[{0}] Successfuly created'.format(id))
         else:
             log.warn(
                 '[{0}] Create package: {1}'.format(id, res.content))
 
-        _delay_request()
-
         return res
 
     def _update_request(self, data, id):
         url = self.api_update.format(owner=self.owner, name=id)
-        res = self._put(url, data)
+        res = self._put(url, data, 'update')
         if res.status_code == 200:
             log.info('[{0}] Successfuly updated'.format(id))
         else:
             log.warn(
                 '[{0}] Update package: {1}'.format(id, res.content))
-        
-        _delay_request()
-        
+
         return res
 
     def _delete_request(self, data, id):
         url = self.api_delete.format(owner=self.owner, id=id)
-        res = self._delete(url, data)
+        res = self._delete(url, data, 'delete')
         if res.status_code == 200:
             log.info('[{0}] Successfuly deleted'.format(id))
         else:
             log.warn(
                 '[{0}] Delete package: {1}'.format(id, res.content))
 
-        _delay_request()
+        return res
+
+    def _patch_request(self, data, id):
+        url = self.api_update.format(owner=self.owner, name=id)
+        res = self._patch(url, data, 'patch')
+        if res.status_code == 200:
+            log.info('[{0}] Successfuly patched: {1}'.format(
+                id, ', '.join(sorted(data))))
+        else:
+            log.warn(
+                '[{0}] Patch package: {1}'.format(id, res.content))
 
         return res
 
+    def _files_request(self, data, baseline, id):
+        """Add, update or delete only files changed since baseline.
+
+        Returns response of the last request or of the first failed one.
+        None is returned when nothing was sent.
+        """
+        diff = _files_diff(data['files'], baseline.get('files', []))
+        if diff is None:
+            return
+        changed, removed = diff
+        res = None
+        if changed:
+            url = self.api_res_create.format(owner=self.owner, name=id)
+            res = self._post(url, {'files': changed}, 'files')
+            if res.status_code != 200:
+                log.warn('[{0}] Update files: {1}'.format(id, res.content))
+                return res
+        for name in removed:
+            url = self.api_res_delete.format(
+                owner=self.owner, name=id,
+                file=quote(name.encode('utf-8'), ''))
+            delete_res = self._delete(url, {}, 'file_delete')
+            if delete_res.status_code == 404:
+                continue
+            res = delete_res
+            if res.status_code != 200:
+                log.warn('[{0}] Delete file: {1}'.format(id, res.content))
+                return res
+        if res is not None:
+            log.info('[{0}] Files updated: {1} changed, {2} removed'.format(
+                id, len(changed), len(removed)))
+        return res
+
+    def _send_update(self, data, id, baseline=None):
+        """Send changes to data.world.
+
+        Only fields changed since baseline are sent with PATCH. Changed
+        files are either sent through files endpoints(when incremental
+        file sync is enabled) or as part of PATCH if none of them were
+        removed. Full PUT is used in all other cases.
+        """
+        if baseline is None:
+            return self._update_request(data, id)
+        incremental = tk.asbool(
+            config.get('ckan.datadotworld.incremental_files', False))
+        patch = tk.asbool(
+            config.get('ckan.datadotworld.patch_updates', True))
+
+        changes = _payload_diff(data, baseline)
+        files_changed = changes.pop('files', None) is not None
+        if changes and not patch:
+            return self._update_request(data, id)
+
+        res = None
+        if files_changed:
+            if incremental:
+                res = self._files_request(data, baseline, id)
+                if res is None:
+                    return self._update_request(data, id)
+                if res.status_code != 200:
+                    return res
+            else:
+                diff = _files_diff(data['files'], baseline.get('files', []))
+                if not patch or diff is None or diff[1]:
+                    return self._update_request(data, id)
+                changes['files'] = diff[0]
+        if changes:
+            res = self._patch_request(changes, id)
+        if res is None:
+            return self._update_request(data, id)
+        return res
+
     def _is_update_required(self, data, id):
         url = self.api_update.format(owner=self.owner, name=id)
-        remote_res = self._get(url)
+        remote_res = self._get(url, 'dirty_check')
         if remote_res.status_code != 200:
             log.warn(
                 '[{0}] Unable to get package for dirty check:{1}'.format(
@@ -372,9 +958,10 @@ class API:
                 return False
         return True
 
-    def _create(self, data, extras, attempt=0):
-        res = self._create_request(data, extras.id)
-        extras.message = res.content
+    def _create(self, data, extras, attempt=0, res=None):
+        if res is None:
+            res = self._create_request(data, extras.id)
+        _record_result(extras, 'create', res)
         if res.status_code == 200:
             resp_json = res.json()
             if 'uri' in resp_json:
@@ -382,10 +969,11 @@ class API:
                 extras.id = new_id
 
             extras.state = States.uptodate
+            _remember_payload(extras, data)
         elif res.status_code == 429:
             log.error('[{0}] Create package error (too many connections)'.format(
                 extras.id))
-            _repeat_request(extras.id, attempt)
+            _repeat_request(extras, res, attempt)
         else:
             extras.state = States.failed
             log.error('[{0}] Create package failed: {1}'.format(
@@ -393,15 +981,29 @@ class API:
 
         return data
 
-    def _update(self, data, extras, attempt=0):
-        if not self._is_update_required(data, extras.id):
-            return data
+    def _mark_up_to_date(self, data, extras):
+        log.debug('[{0}] Package not changed'.format(extras.id))
+        extras.state = States.uptodate
+        _remember_payload(extras, data)
+        return data
+
+    def _update(self, data, extras, attempt=0, force=False, res=None):
+        fingerprint = payload_hash(data)
+        if res is None:
+            if force:
+                up_to_date = not self._is_update_required(data, extras.id)
+            else:
+                up_to_date = extras.payload_hash == fingerprint
+            if up_to_date:
+                return self._mark_up_to_date(data, extras)
+            baseline = None if force else _baseline(extras)
+            res = self._send_update(data, extras.id, baseline)
 
-        res = self._update_request(data, extras.id)
-        extras.message = res.content
+        _record_result(extras, 'update', res)
 
         if res.status_code == 200:
             extras.state = States.uptodate
+            _remember_payload(extras, data)
         elif res.status_code == 404:
             log.warn('[{0}] Package not exists. Creating...'.format(
                 extras.id))
@@ -409,32 +1011,45 @@ class API:
         elif res.status_code == 429:
             log.error('[{0}] Update package error (too many connections)'.format(
                 extras.id))
-            _repeat_request(extras.id, attempt)
+            if force:
+                # remote state is unknown, so do not trust fingerprint
+                _forget_payload(extras)
+            _repeat_request(extras, res, attempt)
         else:
             extras.state = States.failed
             log.error('[{0}] Update package error:{1}'.format(
                 extras.id, res.content))
         return data
 
-    def _delete_dataset(self, data, extras, attempt=0):
-        res = self._delete_request(data, extras.id)
-        extras.message = res.content
+    def _delete_dataset(self, data, extras, attempt=0, res=None):
+        if res is None:
+            res = self._delete_request(data, extras.id)
+        _record_result(extras, 'delete', res)
         if res.status_code in (200, 404):
-            query = model.Session.query(Extras).filter(Extras.id == extras.id)
-            query.delete()
+            query = model.Session.query(Extras).filter(
+                Extras.owner == extras.owner, Extras.id == extras.id)
+            # rows are deleted one by one, so state counters are updated
+            for item in query:
+                model.Session.delete(item)
             log.info('[{0}] deleted from datadotworld_extras table'.format(
                 extras.id))
         elif res.status_code == 429:
             log.error('[{0}] Delete package error (too many connections)'.format(
                 extras.id))
-            _repeat_request(extras.id, attempt)
+            _repeat_request(extras, res, attempt)
         else:
             extras.state = States.failed
             log.error('[{0}] Delete package error:{1}'.format(
                 extras.id, res.content))
         return data
 
-    def sync(self, pkg_dict, attempt=0):
+    def _prepare_sync(self, pkg_dict, attempt=0, enqueued=None):
+        """Load package with its extras and choose sync method.
+
+        `enqueued` is timestamp of job creation. It is ignored by retries
+        and when earlier change is still pending, so sync lag is measured
+        from the first unprocessed change.
+        """
         entity = model.Package.get(pkg_dict['id'])
         pkg_dict = get_action('package_show')(get_context(), {'id': entity.id})
         data_dict = self._format_data(pkg_dict)
@@ -442,9 +1057,11 @@ class API:
         extras = entity.datadotworld_extras
         pkg_state = pkg_dict.get('state')
         if pkg_state == 'deleted':
-            action = self._delete_dataset
+            method = 'delete'
+        elif extras and extras.id:
+            method = 'update'
         else:
-            action = self._update if extras and extras.id else self._create
+            method = 'create'
         if not extras:
             extras = Extras(
                 package=entity, owner=self.owner,
@@ -452,32 +1069,103 @@ class API:
             model.Session.add(extras)
             extras.state = States.pending
 
+        now = datetime.datetime.utcnow()
+        if not attempt and not extras.enqueue_pending:
+            extras.enqueued_at = (
+                datetime.datetime.utcfromtimestamp(enqueued)
+                if enqueued else now)
+        extras.started_at = now
+        extras.attempt = attempt
+        extras.next_attempt = None
+
         try:
             model.Session.commit()
         except Exception as e:
             model.Session.rollback()
             log.error('[sync problem] {0}'.format(e))
 
-        action(data_dict, extras)
+        return method, data_dict, extras
+
+    def _finish_sync(self, extras):
+        extras.finished_at = datetime.datetime.utcnow()
+        if extras.state == States.uptodate:
+            extras.succeeded_at = extras.finished_at
+
+    def sync(self, pkg_dict, attempt=0, force=False, enqueued=None):
+        method, data_dict, extras = self._prepare_sync(
+            pkg_dict, attempt, enqueued)
+        if method == 'delete':
+            self._delete_dataset(data_dict, extras, attempt)
+        elif method == 'update':
+            self._update(data_dict, extras, attempt, force=force)
+        else:
+            self._create(data_dict, extras, attempt)
+        self._finish_sync(extras)
         model.Session.commit()
 
+    def sync_deferred(self, pkg_dict, attempt=0, force=False):
+        """Split sync into network and database parts.
+
+        Returns `(send, finish)` pair. `send` only talks to data.world, so
+        it can be called from worker thread. Its result must be passed to
+        `finish`, which updates extras and must be called from the thread
+        that owns DB session. `finish` returns False if sync failed.
+        """
+        method, data_dict, extras = self._prepare_sync(pkg_dict, attempt)
+        remote_id = extras.id
+
+        if method == 'delete':
+            def send():
+                return self._delete_request(data_dict, remote_id)
+            action = self._delete_dataset
+        elif method == 'update':
+            fingerprint = payload_hash(data_dict)
+            known_fingerprint = extras.payload_hash
+            baseline = None if force else _baseline(extras)
+
+            def send():
+                if force:
+                    if not self._is_update_required(data_dict, remote_id):
+                        return
+                elif known_fingerprint == fingerprint:
+                    return
+                return self._send_update(data_dict, remote_id, baseline)
+            action = partial(self._update, force=force)
+        else:
+            def send():
+                return self._create_request(data_dict, remote_id)
+            action = self._create
+
+        def finish(res):
+            if res is None:
+                self._mark_up_to_date(data_dict, extras)
+            else:
+                action(data_dict, extras, attempt, res=res)
+            self._finish_sync(extras)
+            state = extras.state
+            model.Session.commit()
+            return state != States.failed
+
+        return send, finish
+
     def sync_resources(self, id):
         url = self.api_res_sync.format(
             owner=self.owner,
             name=id
         )
-        resp = self._get(url)
+        resp = self._get(url, 'sync_resources')
         msg = '{0} - {1:20} - {2}'.format(
             resp.status_code, id, resp.content
         )
         log.info(msg)
+        return resp
 
-    def check_credentials(self):
+    def check_credentials(self, timeout=None):
         url = self.api_update.format(
             owner=self.owner,
             name='definitely-fake-dataset-name'
         )
-        resp = self._get(url)
+        resp = self._get(url, 'check_credentials', timeout=timeout)
 
         if resp.status_code == 401:
             return False
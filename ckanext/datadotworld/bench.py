@@ -0,0 +1,255 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sync throughput benchmark against local data.world stand-in.
+
+Stand-in is a tiny HTTP server that accepts the same requests as
+api.data.world, answers them after configurable latency and randomly
+rejects them with 429 or 500 responses. Benchmark creates synthetic
+packages directly in DB(so no background jobs are enqueued), pushes them
+through the sync pipeline and reports throughput and per-stage latency.
+"""
+
+import json
+import time
+import random
+import logging
+import threading
+from collections import defaultdict
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+from pylons import config
+
+import ckan.model as model
+from ckanext.datadotworld.api import notify_deferred
+from ckanext.datadotworld.model.credentials import Credentials
+from ckanext.datadotworld.model.extras import Extras
+from ckanext.datadotworld.model.state_count import StateCount
+from ckanext.datadotworld.model.sync_log import SyncLog
+from ckanext.datadotworld.ratelimit import get_rate
+from ckanext.datadotworld.stats import percentile
+
+log = logging.getLogger(__name__)
+
+STAGES = ('prepare', 'send', 'finish', 'total')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        if server.latency:
+            time.sleep(random.uniform(0.5, 1.5) * server.latency)
+
+        roll = random.random()
+        if roll < server.rate_429:
+            status, body = 429, {'message': 'Too many requests'}
+        elif roll < server.rate_429 + server.error_rate:
+            status, body = 500, {'message': 'Internal error'}
+        else:
+            status = 200
+            path = self.path.split('/v0/datasets', 1)[-1]
+            body = {'message': 'OK', 'uri': 'https://data.world' + path}
+        server.count(self.command, status)
+
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        if status == 429:
+            self.send_header('Retry-After', '1')
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_PUT = do_POST = do_PATCH = do_DELETE = _respond
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class StandIn(ThreadingMixIn, HTTPServer):
+    """Local replacement for api.data.world.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0, rate_429=0, error_rate=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), StandInHandler)
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.error_rate = error_rate
+        self.requests = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @property
+    def api_root(self):
+        return 'http://127.0.0.1:{0}/v0'.format(self.server_address[1])
+
+    def count(self, method, status):
+        with self._lock:
+            self.requests[(method, status)] += 1
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def create_packages(amount, resources=3, tags=5):
+    """Create organization with credentials and synthetic packages.
+    """
+    model.repo.new_revision()
+    suffix = '{0:x}'.format(int(time.time() * 1000))
+    org = model.Group(
+        name='datadotworld-bench-' + suffix, title='data.world bench',
+        type='organization', is_organization=True)
+    model.Session.add(org)
+    model.Session.flush()
+    model.Session.add(Credentials(
+        organization_id=org.id, integration=True,
+        owner='bench-owner', key='bench-key'))
+
+    ids = []
+    for i in range(amount):
+        pkg = model.Package(
+            name='datadotworld-bench-{0}-{1}'.format(suffix, i),
+            title='Benchmark dataset {0}'.format(i),
+            notes='Synthetic dataset for sync benchmark',
+            owner_org=org.id, license_id='cc-by')
+        model.Session.add(pkg)
+        model.Session.flush()
+        for j in range(resources):
+            model.Session.add(model.Resource(
+                package_id=pkg.id, name='Resource {0}'.format(j),
+                url='http://example.com/{0}/{1}.csv'.format(i, j),
+                format='CSV', position=j))
+        for j in range(tags):
+            pkg.add_tag_by_name(u'tag {0}'.format(j), autoflush=False)
+        model.Session.flush()
+        ids.append(pkg.id)
+    model.Session.commit()
+    return org.id, ids
+
+
+def touch_packages(ids):
+    model.repo.new_revision()
+    for id in ids:
+        pkg = model.Package.get(id)
+        pkg.notes = 'Updated at {0}'.format(time.time())
+    model.Session.commit()
+
+
+def cleanup(org_id, ids):
+    # extras are deleted through session, so state counters are updated
+    for extras in model.Session.query(Extras).filter(
+            Extras.package_id.in_(ids)):
+        model.Session.delete(extras)
+    model.Session.query(SyncLog).filter(
+        SyncLog.package_id.in_(ids)).delete(synchronize_session=False)
+    model.Session.query(StateCount).filter_by(
+        organization_id=org_id).delete(synchronize_session=False)
+    model.Session.query(Credentials).filter_by(
+        organization_id=org_id).delete(synchronize_session=False)
+    model.Session.commit()
+    for id in ids:
+        model.Package.get(id).purge()
+    model.Session.commit()
+    model.Group.get(org_id).purge()
+    model.Session.commit()
+
+
+def timed_jobs(ids, timings):
+    """Wrap deferred syncs of packages, recording duration of each stage.
+    """
+    for id in ids:
+        started = time.time()
+        deferred = notify_deferred(id)
+        if deferred is None:
+            continue
+        send, finish = deferred
+        timings['prepare'].append(time.time() - started)
+
+        def timed_send(send=send):
+            send_started = time.time()
+            try:
+                return send()
+            finally:
+                timings['send'].append(time.time() - send_started)
+
+        def timed_finish(result, finish=finish, started=started):
+            finish_started = time.time()
+            try:
+                return finish(result)
+            finally:
+                now = time.time()
+                timings['finish'].append(now - finish_started)
+                timings['total'].append(now - started)
+
+        yield id, timed_send, timed_finish
+
+
+def run(amount, run_jobs, standin, keep=False, overrides=None, rate=0):
+    """Run create and update passes over synthetic packages.
+
+    `run_jobs` consumes iterable of `(label, send, finish)` triples.
+    `rate` overrides `ckan.datadotworld.rate_limit` for the benchmark;
+    default 0 disables limiter, so pipeline itself is measured. Pass
+    None to keep configured limit. Returns list of reports, one per pass.
+    """
+    overrides = dict(overrides or {})
+    overrides['ckan.datadotworld.api_root'] = standin.api_root
+    if rate is not None:
+        overrides['ckan.datadotworld.rate_limit'] = rate
+    previous = dict((key, config.get(key)) for key in overrides)
+    config.update(overrides)
+    rate = get_rate()
+
+    org_id, ids = create_packages(amount)
+    reports = []
+    try:
+        for name in ('create', 'update'):
+            if name == 'update':
+                touch_packages(ids)
+            standin.requests.clear()
+            timings = defaultdict(list)
+            started = time.time()
+            run_jobs(timed_jobs(ids, timings))
+            elapsed = time.time() - started
+            reports.append(dict(
+                name=name,
+                rate=rate,
+                datasets=len(timings['total']),
+                elapsed=elapsed,
+                throughput=len(timings['total']) / elapsed if elapsed else 0,
+                stages=dict(
+                    (stage, dict(
+                        (p, percentile(timings[stage], p))
+                        for p in (50, 95, 99)))
+                    for stage in STAGES),
+                requests=dict(standin.requests),
+            ))
+    finally:
+        if not keep:
+            cleanup(org_id, ids)
+        for key, value in previous.items():
+            if value is None:
+                config.pop(key, None)
+            else:
+                config[key] = value
+    return reports
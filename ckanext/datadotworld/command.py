@@ -16,20 +16,102 @@ from ckan.lib.cli import CkanCommand
 from pylons import config
 import ckan.model as model
 from ckanext.datadotworld.model.extras import Extras
+from ckanext.datadotworld.model.credentials import Credentials
 from ckanext.datadotworld.api import API
-from ckanext.datadotworld.api import compat_enqueue
-from ckanext.datadotworld.api import syncronize
+from ckanext.datadotworld.api import enqueue_batches
+from ckanext.datadotworld.api import release_retries
+from ckanext.datadotworld.api import notify_deferred
+from ckanext.datadotworld.api import prune_sync_log
+from ckanext.datadotworld import metrics
+from ckanext.datadotworld import counters
+from ckanext.datadotworld.stats import percentile
 import paste.script
 import logging
+import sys
+import Queue
+from multiprocessing.pool import ThreadPool
 from migrate.versioning.shell import main
 from migrate.exceptions import DatabaseAlreadyControlledError
 import os.path as path
+import time
+import datetime
+from functools import partial
+from itertools import groupby
 
 log = logging.getLogger('ckanext.datadotworld')
 repository = path.realpath(path.join(
     path.dirname(__file__), '../../datadotworld_repository'))
 
 
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
+def _run_bulk(jobs, workers, total=None):
+    """Run network part of jobs on thread pool.
+
+    `jobs` is an iterable of `(label, send, finish)` triples. Only `send`
+    is executed by pool threads, while iteration over `jobs` and `finish`
+    callbacks happen in main thread, so all DB work stays there. `finish`
+    receives result of `send` and returns False when job failed.
+    """
+    pool = ThreadPool(workers)
+    done = Queue.Queue()
+    stats = {'total': 0, 'errors': 0}
+    started = time.time()
+
+    def submit(label, send, finish):
+        def call():
+            try:
+                done.put((label, finish, send(), None))
+            except Exception as e:
+                done.put((label, finish, None, e))
+        pool.apply_async(call)
+
+    def collect():
+        label, finish, result, error = done.get()
+        if error is None:
+            try:
+                if finish(result) is False:
+                    error = 'failed'
+            except Exception as e:
+                # keep session usable for following jobs
+                model.Session.rollback()
+                error = e
+        stats['total'] += 1
+        if error is not None:
+            stats['errors'] += 1
+            log.warn('[{0}] {1}'.format(label, error))
+        elapsed = time.time() - started
+        sys.stdout.write('\r{0}/{1} done, {2} errors, {3:.1f}/s'.format(
+            stats['total'], total or '?', stats['errors'],
+            stats['total'] / elapsed if elapsed else 0))
+        sys.stdout.flush()
+
+    in_flight = 0
+    try:
+        for label, send, finish in jobs:
+            submit(label, send, finish)
+            in_flight += 1
+            # keep amount of prepared jobs bounded
+            while in_flight >= workers * 2:
+                collect()
+                in_flight -= 1
+        while in_flight:
+            collect()
+            in_flight -= 1
+    finally:
+        pool.close()
+        pool.join()
+        metrics.flush()
+
+    elapsed = time.time() - started
+    print('\nProcessed {0} items in {1:.1f}s ({2:.1f}/s), {3} errors'.format(
+        stats['total'], elapsed,
+        stats['total'] / elapsed if elapsed else 0, stats['errors']))
+    return stats
+
+
 class DataDotWorldCommand(CkanCommand):
     """
     ckanext-datadotworld management commands.
@@ -41,6 +123,22 @@ class DataDotWorldCommand(CkanCommand):
         downgrade - delete tables provided by datadotworld
         upgrade - create/update required tables
         push_failed - try to push prefiously failed datasets to data.world
+        sync_resources - ask data.world to re-fetch remote resources
+            Both push_failed and sync_resources accept `--workers N`
+            option: requests are sent inline using N threads instead
+            of enqueuing jobs
+        release_retries - enqueue delayed retries that are due. Use
+            `--interval SECONDS` to keep polling instead of single run
+        bench - measure sync throughput against local data.world
+            stand-in. Options: --count, --latency, --rate-429,
+            --error-rate, --workers, --rate, --keep
+        standin - serve local data.world stand-in on --port. Point
+            `ckan.datadotworld.api_root` to it to test real workers
+        sync_lag - report enqueue-to-completion lag percentiles and
+            number of pending changes per organization
+        prune_sync_log - delete sync history older than `--days DAYS`
+            (`ckan.datadotworld.sync_log_retention_days` by default)
+        recount - rebuild per-organization sync state counters
     """
 
     summary = __doc__.split('\n')[0]
@@ -50,6 +148,33 @@ class DataDotWorldCommand(CkanCommand):
     parser.add_option('-c', '--config', dest='config',
                       default='development.ini',
                       help='Config file to use.')
+    parser.add_option('--interval', dest='interval', type='float',
+                      default=0,
+                      help='Polling interval for release_retries.')
+    parser.add_option('--workers', dest='workers', type='int',
+                      default=0,
+                      help='Number of threads for inline requests.')
+    parser.add_option('--count', dest='count', type='int', default=100,
+                      help='Number of synthetic datasets for bench.')
+    parser.add_option('--latency', dest='latency', type='float',
+                      default=0.05,
+                      help='Average latency of stand-in responses.')
+    parser.add_option('--rate-429', dest='rate_429', type='float',
+                      default=0,
+                      help='Share of stand-in responses with 429 status.')
+    parser.add_option('--error-rate', dest='error_rate', type='float',
+                      default=0,
+                      help='Share of stand-in responses with 500 status.')
+    parser.add_option('--rate', dest='rate', type='float', default=0,
+                      help='Rate limit for bench, requests per second; '
+                      '0 disables limiter, negative keeps configured one.')
+    parser.add_option('--port', dest='port', type='int', default=8765,
+                      help='Port of stand-in server.')
+    parser.add_option('--keep', dest='keep', action='store_true',
+                      default=False,
+                      help='Do not remove synthetic datasets after bench.')
+    parser.add_option('--days', dest='days', type='int', default=None,
+                      help='Retention period of sync log.')
 
     def command(self):
         self._load_config()
@@ -70,6 +195,18 @@ class DataDotWorldCommand(CkanCommand):
             self._push_failed()
         elif self.args[0] == 'sync_resources':
             self._sync_resources()
+        elif self.args[0] == 'release_retries':
+            self._release_retries()
+        elif self.args[0] == 'bench':
+            self._bench()
+        elif self.args[0] == 'standin':
+            self._standin()
+        elif self.args[0] == 'sync_lag':
+            self._sync_lag()
+        elif self.args[0] == 'prune_sync_log':
+            self._prune_sync_log()
+        elif self.args[0] == 'recount':
+            self._recount()
         else:
             print(self.usage)
 
@@ -78,28 +215,174 @@ class DataDotWorldCommand(CkanCommand):
         # use incorrect config then and you'll receive error like
         # "no section app:main in config file"
         # from ckan.lib.celery_app import celery
-        ckan_ini_filepath = path.abspath(config['__file__'])
-        failed = model.Session.query(Extras).filter_by(state='failed')
-
-        for record in failed:
-            compat_enqueue(
-                'datadotworld.syncronize',
-                syncronize,
-                args=[record.package_id, ckan_ini_filepath])
-
-    def _sync_resources(self):
+        failed = model.Session.query(Extras.package_id).filter_by(
+            state='failed')
+        if self.options.workers > 0:
+            ids = [record.package_id for record in failed]
+            _run_bulk(
+                self._push_failed_jobs(ids), self.options.workers, len(ids))
+        else:
+            enqueue_batches(record.package_id for record in failed)
 
-        queue = model.Session.query(Extras).join(model.Package).join(
-            model.Resource).filter(model.Resource.url_type == None)
-        for record in queue:
+    def _push_failed_jobs(self, ids):
+        for id in ids:
             try:
-                creds = record.package.get_groups(
-                    'organization').pop().datadotworld_credentials
+                deferred = notify_deferred(id)
             except Exception as e:
-                print(e)
+                model.Session.rollback()
+                log.warn('[{0}] {1}'.format(id, e))
+                continue
+            if deferred is None:
                 continue
-            api = API(creds.owner, creds.key)
-            api.sync_resources(record.id)
+            send, finish = deferred
+            yield id, send, finish
+
+    def _release_retries(self):
+        while True:
+            released = release_retries()
+            if released:
+                print('{0} retries released'.format(released))
+            if self.options.interval <= 0:
+                break
+            time.sleep(self.options.interval)
+
+    def _prune_sync_log(self):
+        amount = prune_sync_log(self.options.days)
+        print('{0} sync log entries deleted'.format(amount))
+
+    def _recount(self):
+        amount = counters.recount()
+        print('{0} state counters rebuilt'.format(amount))
+
+    def _sync_resources(self):
+        if self.options.workers > 0:
+            _run_bulk(
+                self._sync_resources_jobs(), self.options.workers)
+            return
+        for api, id in self._sync_resources_queue():
+            api.sync_resources(id)
+        metrics.flush()
+
+    def _sync_resources_queue(self):
+        """Stream remote ids of datasets with remote resources.
+
+        Each dataset is yielded once, with API client built from its
+        organization credentials. Rows are ordered by owner, so single
+        client is used for all datasets of the same organization.
+        """
+        has_remote = model.Session.query(model.Resource.id).filter(
+            model.Resource.package_id == model.Package.id,
+            model.Resource.url_type == None
+        ).exists()
+        queue = model.Session.query(
+            Extras.id, Credentials.owner, Credentials.key
+        ).join(
+            model.Package, Extras.package_id == model.Package.id
+        ).join(
+            Credentials,
+            Credentials.organization_id == model.Package.owner_org
+        ).filter(has_remote).order_by(
+            Credentials.owner, Credentials.key, Extras.id
+        ).yield_per(1000)
+
+        for (owner, key), records in groupby(
+                queue, lambda record: (record.owner, record.key)):
+            api = API(owner, key)
+            for record in records:
+                yield api, record.id
+
+    def _sync_resources_jobs(self):
+        for api, id in self._sync_resources_queue():
+            yield (
+                id,
+                partial(api.sync_resources, id),
+                lambda resp: resp.status_code == 200)
+
+    def _standin_server(self, port=0):
+        from ckanext.datadotworld.bench import StandIn
+        return StandIn(
+            port, self.options.latency,
+            self.options.rate_429, self.options.error_rate)
+
+    def _standin(self):
+        standin = self._standin_server(self.options.port)
+        print('Serving data.world stand-in at {0}'.format(standin.api_root))
+        standin.serve_forever()
+
+    def _bench(self):
+        from ckanext.datadotworld import bench
+        standin = self._standin_server()
+        standin.start()
+        workers = max(1, self.options.workers)
+        try:
+            reports = bench.run(
+                self.options.count,
+                lambda jobs: _run_bulk(jobs, workers, self.options.count),
+                standin, self.options.keep,
+                rate=None if self.options.rate < 0 else self.options.rate)
+        finally:
+            standin.shutdown()
+
+        for report in reports:
+            print('\n[{name}] {datasets} datasets in {elapsed:.2f}s: '
+                  '{throughput:.1f} datasets/s'.format(**report))
+            print('  rate limit: {0}'.format(
+                '{0:g} req/s per owner'.format(report['rate'])
+                if report['rate'] > 0 else 'disabled'))
+            for stage in bench.STAGES:
+                print('  {0:8} p50={1:.4f}s p95={2:.4f}s p99={3:.4f}s'.format(
+                    stage, *[report['stages'][stage][p]
+                             for p in (50, 95, 99)]))
+            total = sum(report['requests'].values())
+            print('  requests: {0} ({1})'.format(total, ', '.join(
+                '{0} {1}: {2}'.format(method, status, amount)
+                for (method, status), amount
+                in sorted(report['requests'].items()))))
+
+    def _sync_lag_report(self):
+        """Collect sync lag statistics per organization.
+
+        Lag is time between enqueueing the first unprocessed change and
+        completion of the sync that processed it. Pending changes are
+        changes enqueued after the last completed sync.
+        """
+        now = datetime.datetime.utcnow()
+        query = model.Session.query(
+            model.Group.name, Extras.enqueued_at, Extras.finished_at
+        ).join(
+            model.Package, model.Package.owner_org == model.Group.id
+        ).join(
+            Extras, Extras.package_id == model.Package.id
+        ).filter(
+            Extras.enqueued_at != None
+        ).order_by(model.Group.name)
+
+        report = []
+        for org, rows in groupby(query, lambda row: row.name):
+            lags = []
+            pending = []
+            for row in rows:
+                if row.finished_at is None or (
+                        row.enqueued_at > row.finished_at):
+                    pending.append(_seconds(now - row.enqueued_at))
+                else:
+                    lags.append(_seconds(row.finished_at - row.enqueued_at))
+            report.append({
+                'org': org,
+                'synced': len(lags),
+                'p50': percentile(lags, 50),
+                'p95': percentile(lags, 95),
+                'p99': percentile(lags, 99),
+                'pending': len(pending),
+                'oldest_pending': max(pending) if pending else 0,
+            })
+        return report
+
+    def _sync_lag(self):
+        for item in self._sync_lag_report():
+            print('{org}: {synced} synced, lag p50={p50:.1f}s '
+                  'p95={p95:.1f}s p99={p99:.1f}s; {pending} pending, '
+                  'oldest {oldest_pending:.1f}s'.format(**item))
 
     def _init(self):
         try:
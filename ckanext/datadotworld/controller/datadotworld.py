@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hmac
 import json
 import logging
 import ckan.lib.base as base
@@ -20,73 +21,141 @@ import ckan.logic as logic
 import ckan.plugins.toolkit as tk
 from ckanext.datadotworld.model.credentials import Credentials
 from ckanext.datadotworld.model.extras import Extras
-from ckan.common import _, request, c
-import ckan.lib.helpers as h
-from ckanext.datadotworld.api import API
-from ckanext.datadotworld.api import compat_enqueue
-from ckanext.datadotworld.api import syncronize
+from ckan.common import _, request, response, c
 from pylons import config
-import os
-from ckan.lib.celery_app import celery
-from sqlalchemy import func
+import ckan.lib.helpers as h
+from ckanext.datadotworld.api import syncronize_org, check_credentials
+from ckanext.datadotworld import metrics
+from ckanext.datadotworld import counters
+from ckanext.datadotworld import jobs
+from ckanext.datadotworld.model import ValidationStates
 import ckanext.datadotworld.helpers as dh
 
 logger = logging.getLogger(__name__)
 
 
-def syncronize_org(id):
-    ckan_ini_filepath = os.path.abspath(config['__file__'])
-    packages = model.Session.query(model.Package).filter_by(
-        owner_org=id
-    )
-    for pkg in packages:
-        compat_enqueue(
-            'datadotworld.syncronize',
-            syncronize,
-            args=[pkg.id, ckan_ini_filepath])
+def _metrics_allowed():
+    if c.userobj and c.userobj.sysadmin:
+        return True
+    token = config.get('ckan.datadotworld.metrics_token')
+    if not token:
+        return False
+    header = request.headers.get('Authorization') or ''
+    expected = 'Bearer ' + token
+    return hmac.compare_digest(
+        _to_bytes(header), _to_bytes(expected))
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
 
 
 class DataDotWorldController(base.BaseController):
-    def list_sync(self, state, org_id=None):
-        orgs = dh.admin_in_orgs(c.user)
-        org = model.Group.get(org_id)
-        if not orgs or (org and org not in orgs):
-            base.abort(401, _('User %r not authorized to see this page') % (
-                c.user))
-        extra = {
-            'displayed_state': state
-        }
-        ids = [o.id for o in orgs]
+    def metrics(self):
+        if not metrics.enabled():
+            base.abort(404, _('Metrics are disabled'))
+        if not _metrics_allowed():
+            base.abort(401, _('Not authorized to see this page'))
+        # numbers of web process itself(credential checks)
+        metrics.flush()
+        response.headers['Content-Type'] = (
+            'text/plain; version=0.0.4; charset=utf-8')
+        return metrics.render()
+
+    def _list_sync_page(self, state, org_ids, org, after, text, limit):
+        """Single page of packages in state ordered by name.
+
+        Returns list of rows and name of the last one when next page
+        exists.
+        """
         query = model.Session.query(
             model.Package.name,
             model.Package.title,
             Extras.message
-        ).join(
-            model.Group, model.Package.owner_org == model.Group.id
         ).join(
             Extras
         ).filter(
             Extras.state == state
         )
         if org:
-            query = query.filter(
-                model.Group.id == org.id
-            )
+            query = query.filter(model.Package.owner_org == org.id)
         else:
-            query = query.filter(
-                model.Group.id.in_(ids)
-            )
-        extra['datasets'] = query.all()
-        for pkg in extra['datasets']:
+            query = query.filter(model.Package.owner_org.in_(org_ids))
+        if text:
+            pattern = '%{0}%'.format(
+                text.replace('\\', '\\\\').replace(
+                    '%', '\\%').replace('_', '\\_'))
+            query = query.filter(Extras.message.ilike(pattern, escape='\\'))
+        if after:
+            query = query.filter(model.Package.name > after)
+        rows = query.order_by(model.Package.name).limit(limit + 1).all()
+        next_after = rows[limit - 1].name if len(rows) > limit else None
+        return rows[:limit], next_after
+
+    def list_sync(self, state, org_id=None):
+        org_ids = dh.admin_org_ids(c.user)
+        org_id = org_id or request.params.get('org')
+        org = model.Group.get(org_id) if org_id else None
+        if org_id and org is None:
+            base.abort(404, _('Organization not found'))
+        if not org_ids or (org and org.id not in org_ids):
+            base.abort(401, _('User %r not authorized to see this page') % (
+                c.user))
+        after = request.params.get('after')
+        text = request.params.get('q', '').strip()
+        limit = max(1, dh.config_int(
+            'ckan.datadotworld.list_sync_page_size', 50))
+        rows, next_after = self._list_sync_page(
+            state, org_ids, org, after, text, limit)
+
+        datasets = []
+        for row in rows:
             try:
-                pkg.message = json.loads(pkg.message)
+                message = json.loads(row.message)
+                if not isinstance(message, dict):
+                    raise ValueError
             except Exception:
-                pkg.message = {
-                    'RAW message': pkg.message
+                message = {
+                    'RAW message': row.message
                 }
+            datasets.append({
+                'name': row.name,
+                'title': row.title,
+                'message': message
+            })
+
+        params = {'state': state}
+        if org:
+            params['org'] = org.name
+        if text:
+            params['q'] = text
+        if request.params.get('format') == 'json':
+            response.headers['Content-Type'] = (
+                'application/json; charset=utf-8')
+            return json.dumps({
+                'datasets': datasets,
+                'next': next_after
+            })
+
+        extra = {
+            'displayed_state': state,
+            'datasets': datasets,
+            'q': text,
+            'org': org,
+            'next_url': h.url_for(
+                'list_dataworld_sync', after=next_after, **params
+            ) if next_after else None,
+            'first_url': h.url_for(
+                'list_dataworld_sync', **params) if after else None
+        }
         return base.render('datadotworld/list_sync.html', extra_vars=extra)
 
     def edit(self, id):
+        background = tk.asbool(
+            config.get('ckan.datadotworld.validate_in_background', False))
+
         def validate(data):
             error_dict = {}
             has_owner = data.get('owner')
@@ -102,11 +171,14 @@ class DataDotWorldController(base.BaseController):
                     error_dict['show_links'] = [
                         'This option available only '
                         'if credentials are provided']
-            if not error_dict:
-                api = API(has_owner, has_key)
-                check = api.check_credentials()
-                if not check:
+            if not error_dict and not background:
+                state = check_credentials(c.credentials)
+                if state == ValidationStates.invalid:
                     error_dict['key'] = ['Incorrect key']
+                elif state == ValidationStates.error:
+                    error_dict['key'] = [
+                        'Unable to verify key: {0}'.format(
+                            c.credentials.validation_message)]
             if error_dict:
                 raise logic.ValidationError(error_dict)
 
@@ -150,29 +222,27 @@ class DataDotWorldController(base.BaseController):
                 extra['errors'] = e.error_dict
                 extra['error_summary'] = e.error_summary
             else:
-
-                query = model.Session.query(Extras).join(
-                    model.Package
-                ).join(
-                    model.Group, model.Package.owner_org == model.Group.id
-                ).filter(model.Group.id == c.group.id)
-                for item in query:
-                    item.state = 'pending'
-
+                integration = tk.asbool(c.credentials.integration)
+                # without integration result of the check is not used
+                check_later = background and integration and (
+                    not c.credentials.is_validated)
+                if check_later:
+                    c.credentials.validation_state = ValidationStates.pending
+                    c.credentials.validation_message = None
                 model.Session.commit()
-                h.flash_success('Saved')
-                if tk.asbool(c.credentials.integration):
-                    syncronize_org(c.group.id)
+                dh.invalidate_creds(c.group.id, c.group.name)
+                if check_later:
+                    # sync starts after successful check
+                    h.flash_success('Saved. Credentials are being verified')
+                    jobs.enqueue_validation(c.group.id)
+                else:
+                    h.flash_success('Saved')
+                    if integration:
+                        # packages are marked as pending only when their
+                        # sync actually starts
+                        syncronize_org(c.group.id)
                 return base.redirect_to('organization_dataworld', id=id)
 
-        query = model.Session.query(
-            func.count(model.Package.id).label('total'),
-            Extras.state
-        ).join(model.Group, model.Package.owner_org == model.Group.id).join(
-            Extras
-        ).group_by(Extras.state).filter(model.Package.owner_org == c.group.id)
-
-        for amount, state in query:
-            stats[state] = amount
+        stats.update(counters.get_counts(c.group.id))
         return base.render(
             'organization/edit_credentials.html', extra_vars=extra)
@@ -0,0 +1,179 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-organization counters of datasets in each sync state.
+
+Counters are kept in `datadotworld_state_counts` table and are updated
+by session hook right before every flush, so they are changed in the
+same transaction as extras. Old values are read from database(not yet
+updated by the flush) under lock of package rows and compared with
+objects in the session, which covers state changes, new and deleted
+extras and packages moved to another organization. Changes made with
+bulk queries are not tracked; `paster datadotworld recount` rebuilds
+counters from scratch.
+"""
+
+import logging
+
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, attributes
+from sqlalchemy.exc import IntegrityError
+
+import ckan.model as model
+from ckanext.datadotworld.model import States
+from ckanext.datadotworld.model.extras import Extras
+from ckanext.datadotworld.model.state_count import StateCount
+
+log = logging.getLogger(__name__)
+
+FILL = '''
+INSERT INTO datadotworld_state_counts (organization_id, state, amount)
+SELECT package.owner_org, datadotworld_extras.state, count(*)
+FROM datadotworld_extras
+JOIN package ON package.id = datadotworld_extras.package_id
+WHERE package.owner_org IS NOT NULL
+  AND datadotworld_extras.state IS NOT NULL
+GROUP BY package.owner_org, datadotworld_extras.state
+'''
+
+
+def _package_id(extras):
+    if extras.package_id:
+        return extras.package_id
+    if extras.package is not None:
+        return extras.package.id
+
+
+def _stored(session, ids):
+    """Organization and sync state of packages as they are in database.
+
+    State is None for packages without extras. Packages stay locked
+    until the end of transaction.
+    """
+    extras = Extras.__table__
+    package = model.package_table
+    # Package rows are locked first, so concurrent transactions that
+    # change the same packages are serialized and the following select
+    # sees state committed by the previous one. Extras row cannot be
+    # locked instead, because it may not exist yet.
+    session.execute(select([package.c.id]).where(
+        package.c.id.in_(list(ids))
+    ).order_by(package.c.id).with_for_update()).fetchall()
+    query = select([
+        package.c.id, package.c.owner_org, extras.c.state
+    ]).select_from(
+        package.outerjoin(extras, package.c.id == extras.c.package_id)
+    ).where(package.c.id.in_(list(ids)))
+    return dict(
+        (row[0], (row[1], row[2])) for row in session.execute(query))
+
+
+def _changes(session):
+    """Collect counter deltas for pending changes of the session.
+    """
+    current = {}
+    moved = {}
+    for obj in session.new:
+        if isinstance(obj, Extras):
+            current[_package_id(obj)] = obj
+    for obj in session.dirty:
+        if isinstance(obj, Extras):
+            current[_package_id(obj)] = obj
+        elif isinstance(obj, model.Package) and attributes.get_history(
+                obj, 'owner_org').has_changes():
+            moved[obj.id] = obj.owner_org
+    for obj in session.deleted:
+        if isinstance(obj, Extras):
+            current[_package_id(obj)] = None
+    current.pop(None, None)
+    ids = set(current) | set(moved)
+    if not ids:
+        return {}
+
+    stored = _stored(session, ids)
+    deltas = {}
+    for pkg_id in ids:
+        extras = current.get(pkg_id)
+        if pkg_id in stored:
+            org, old_state = stored[pkg_id]
+        else:
+            # package is created in the same flush
+            org, old_state = None, None
+            if extras is not None and extras.package is not None:
+                org = extras.package.owner_org
+        old = (org, old_state) if org and old_state else None
+
+        org = moved.get(pkg_id, org)
+        if pkg_id in current:
+            state = None if extras is None else (
+                extras.state or States.uptodate)
+        else:
+            state = old_state
+        new = (org, state) if org and state else None
+
+        if old == new:
+            continue
+        if old:
+            deltas[old] = deltas.get(old, 0) - 1
+        if new:
+            deltas[new] = deltas.get(new, 0) + 1
+    return deltas
+
+
+def _apply(conn, org, state, delta):
+    table = StateCount.__table__
+    where = (table.c.organization_id == org) & (table.c.state == state)
+    update = table.update().where(where).values(
+        amount=table.c.amount + delta)
+    if conn.execute(update).rowcount:
+        return
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(table.insert().values(
+            organization_id=org, state=state, amount=delta))
+        savepoint.commit()
+    except IntegrityError:
+        # counter was created by another transaction in the meantime
+        savepoint.rollback()
+        conn.execute(update)
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    with session.no_autoflush:
+        deltas = _changes(session)
+    if not deltas:
+        return
+    conn = session.connection()
+    # same order in every transaction, so concurrent updates do not deadlock
+    for (org, state), delta in sorted(deltas.items()):
+        if delta:
+            _apply(conn, org, state, delta)
+
+
+def get_counts(org_id):
+    """Amount of packages of organization in each sync state.
+    """
+    query = model.Session.query(StateCount.state, StateCount.amount).filter(
+        StateCount.organization_id == org_id)
+    return dict((state, amount) for state, amount in query)
+
+
+def recount():
+    """Rebuild all counters from extras.
+    """
+    model.Session.query(StateCount).delete(synchronize_session=False)
+    model.Session.execute(FILL)
+    model.Session.commit()
+    return model.Session.query(StateCount).count()
@@ -12,10 +12,242 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import logging
+from collections import namedtuple
+
+from pylons import config, request, tmpl_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
 import ckan.model as model
+from ckanext.datadotworld.cache import LRUCache
+from ckanext.datadotworld.model.credentials import Credentials
+
+log = logging.getLogger(__name__)
+
+DATADOTWORLD_ROOT = 'https://data.world'
+
+# detached copy of credentials, safe to share between sessions and threads
+CredentialsInfo = namedtuple(
+    'CredentialsInfo',
+    ['organization_id', 'integration', 'show_links', 'key', 'owner'])
+
+_creds_cache = LRUCache(10000)
+# memberships are cleared from cache when they are changed in this process
+_admins_cache = LRUCache(10000)
+_missing = object()
+
+
+def config_int(name, default):
+    value = config.get(name, default)
+    try:
+        return int(value)
+    except Exception as e:
+        log.info('Wrong variable format for {0}.'.format(name))
+        return default
+
+
+def config_float(name, default):
+    value = config.get(name, default)
+    try:
+        return float(value)
+    except Exception as e:
+        log.info('Wrong variable format for {0}.'.format(name))
+        return default
+
+
+def _admin_memberships(name):
+    return model.Session.query(model.Member.group_id).join(
+        model.Group, model.Group.id == model.Member.group_id
+    ).join(
+        model.User, model.User.id == model.Member.table_id
+    ).filter(
+        model.User.name == name,
+        model.Member.table_name == 'user',
+        model.Member.state == 'active',
+        model.Member.capacity == 'admin',
+        model.Group.type == 'organization'
+    )
+
+
+def _cached_admins(key, load):
+    ttl = config_int('ckan.datadotworld.admin_cache_ttl', 30)
+    if ttl > 0:
+        value = _admins_cache.get(key, _missing)
+        if value is not _missing:
+            return value
+    value = load()
+    if ttl > 0:
+        _admins_cache.set(key, value, ttl)
+    return value
+
+
+def admin_org_ids(name):
+    """Ids of organizations where user is admin.
+    """
+    if not name:
+        return ()
+    return _cached_admins(('ids', name), lambda: tuple(
+        row.group_id for row in _admin_memberships(name)))
+
+
+def is_admin_in_orgs(name):
+    """Whether user is admin of at least one organization.
+    """
+    if not name:
+        return False
+    return _cached_admins(('any', name), lambda: model.Session.query(
+        _admin_memberships(name).exists()).scalar())
+
 
 def admin_in_orgs(name):
-    user = model.User.get(name)
-    if not user:
+    ids = admin_org_ids(name)
+    if not ids:
         return []
-    return user.get_groups('organization', 'admin')
+    return model.Session.query(model.Group).filter(
+        model.Group.id.in_(ids)).all()
+
+
+@event.listens_for(Session, 'before_flush')
+def _watch_memberships(session, flush_context, instances):
+    for objects in (session.new, session.dirty, session.deleted):
+        for obj in objects:
+            if isinstance(obj, model.Member):
+                session.info['datadotworld_members_changed'] = True
+                return
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_admins(session):
+    if session.info.pop('datadotworld_members_changed', False):
+        _admins_cache.clear()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_memberships(session):
+    session.info.pop('datadotworld_members_changed', None)
+
+
+def datadotworld_link(owner, package=None):
+    """Create link to data.world dataset.
+    """
+    parts = [config.get('ckan.datadotworld.root', DATADOTWORLD_ROOT), owner]
+    if package:
+        parts.append(package)
+    return '/'.join(parts)
+
+
+def _load_creds(org_id):
+    org = model.Group.get(org_id)
+    if not org:
+        return
+    creds = org.datadotworld_credentials
+    if creds is None:
+        return
+    return CredentialsInfo(
+        org.id, creds.integration, creds.show_links, creds.key, creds.owner)
+
+
+def _in_web_request():
+    try:
+        return 'PATH_INFO' in request.environ
+    except (TypeError, AttributeError):
+        # request is not registered for this thread
+        return False
+
+
+def _request_creds_cache():
+    """Credentials cache of current web request.
+
+    None is returned outside of request(background jobs, commands). They
+    may register process-wide tmpl_context, which would turn the cache
+    into unlimited one.
+    """
+    if not _in_web_request():
+        return
+    try:
+        # missing attributes of context are empty strings
+        cache = getattr(tmpl_context, '_datadotworld_creds', None)
+        if not isinstance(cache, dict):
+            cache = tmpl_context._datadotworld_creds = {}
+    except TypeError:
+        # tmpl_context is not registered for this thread
+        return
+    return cache
+
+
+def datadotworld_creds(org_id, fresh=False):
+    """Find data.world credentials by org id or name.
+
+    Result is cached per request and, for
+    `ckan.datadotworld.credentials_cache_ttl` seconds, per process.
+    `fresh` forces reading of credentials from database.
+    """
+    if not org_id:
+        return
+    request_cache = _request_creds_cache()
+    if not fresh and request_cache is not None and org_id in request_cache:
+        return request_cache[org_id]
+
+    ttl = config_int('ckan.datadotworld.credentials_cache_ttl', 60)
+    creds = _missing
+    if ttl > 0 and not fresh:
+        creds = _creds_cache.get(org_id, _missing)
+    if creds is _missing:
+        creds = _load_creds(org_id)
+        if ttl > 0:
+            _creds_cache.set(org_id, creds, ttl)
+    if request_cache is not None:
+        request_cache[org_id] = creds
+    return creds
+
+
+def datadotworld_prefetch_creds(org_ids):
+    """Load credentials of all organizations on the page at once.
+
+    Credentials of organizations(given by id) that are not cached yet
+    are read with single query and cached, so following
+    `datadotworld_creds` calls do not touch database. Returns empty
+    string, so it can be used in template expressions.
+    """
+    ttl = config_int('ckan.datadotworld.credentials_cache_ttl', 60)
+    request_cache = _request_creds_cache()
+    missing = set()
+    for org_id in org_ids:
+        if not org_id:
+            continue
+        if request_cache is not None and org_id in request_cache:
+            continue
+        if ttl > 0:
+            creds = _creds_cache.get(org_id, _missing)
+            if creds is not _missing:
+                if request_cache is not None:
+                    request_cache[org_id] = creds
+                continue
+        missing.add(org_id)
+    if not missing:
+        return ''
+
+    found = dict((org_id, None) for org_id in missing)
+    query = model.Session.query(Credentials).filter(
+        Credentials.organization_id.in_(missing))
+    for creds in query:
+        found[creds.organization_id] = CredentialsInfo(
+            creds.organization_id, creds.integration, creds.show_links,
+            creds.key, creds.owner)
+    for org_id, creds in found.items():
+        if ttl > 0:
+            _creds_cache.set(org_id, creds, ttl)
+        if request_cache is not None:
+            request_cache[org_id] = creds
+    return ''
+
+
+def invalidate_creds(*keys):
+    """Drop cached credentials of organization by its id and name.
+    """
+    request_cache = _request_creds_cache()
+    for key in keys:
+        _creds_cache.delete(key)
+        if request_cache is not None:
+            request_cache.pop(key, None)
@@ -0,0 +1,84 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight job helpers used by web processes.
+
+This module must not import the sync stack(`ckanext.datadotworld.api`),
+so jobs are referenced by Celery task name or by dotted path for RQ.
+"""
+
+import time
+import datetime
+import os.path
+
+from pylons import config
+from sqlalchemy import or_
+
+import ckan.model as model
+from ckanext.datadotworld.model.extras import Extras
+
+SYNCRONIZE = 'ckanext.datadotworld.api.syncronize'
+VALIDATE_CREDENTIALS = 'ckanext.datadotworld.api.validate_credentials'
+
+
+def compat_enqueue(name, fn, args=None):
+    u'''
+    Enqueue a background job using Celery or RQ.
+    '''
+    try:
+        # Try to use RQ
+        from ckan.lib.jobs import enqueue
+        enqueue(fn, args=args)
+    except ImportError:
+        # Fallback to Celery
+        from ckan.lib.celery_app import celery
+        celery.send_task(name, args=args)
+
+
+def mark_enqueued(pkg_id, enqueued):
+    """Remember enqueue time of the package change.
+
+    Time is kept if there is already enqueued change that is not
+    processed yet, so lag is measured from the oldest pending change.
+    Change is saved with the current transaction.
+    """
+    model.Session.query(Extras).filter(
+        Extras.package_id == pkg_id,
+        or_(Extras.enqueued_at == None,
+            Extras.finished_at >= Extras.enqueued_at)
+    ).update({
+        'enqueued_at': datetime.datetime.utcfromtimestamp(enqueued)
+    }, synchronize_session=False)
+
+
+def enqueue_sync(pkg_id):
+    """Enqueue sync of single package.
+    """
+    enqueued = time.time()
+    mark_enqueued(pkg_id, enqueued)
+    ckan_ini_filepath = os.path.abspath(config['__file__'])
+    compat_enqueue(
+        'datadotworld.syncronize',
+        SYNCRONIZE,
+        args=[pkg_id, ckan_ini_filepath, 0, False, enqueued])
+
+
+def enqueue_validation(org_id):
+    """Enqueue background check of organization credentials.
+    """
+    ckan_ini_filepath = os.path.abspath(config['__file__'])
+    compat_enqueue(
+        'datadotworld.validate_credentials',
+        VALIDATE_CREDENTIALS,
+        args=[org_id, ckan_ini_filepath])
@@ -0,0 +1,211 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Sync pipeline metrics in Prometheus text format.
+
+Every process accumulates counters in memory and periodically adds them
+to `datadotworld_metrics` table, so numbers of all workers on all hosts
+that share CKAN database are aggregated there. Histograms are stored as
+their cumulative `_bucket`, `_sum` and `_count` counters.
+"""
+
+import json
+import time
+import logging
+import threading
+
+from pylons import config
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import ckan.model as model
+import ckan.plugins.toolkit as tk
+from ckanext.datadotworld.model.metric import Metric
+from ckanext.datadotworld.helpers import config_float
+
+log = logging.getLogger(__name__)
+
+# name, type, help, histogram buckets
+METRICS = [
+    ('datadotworld_requests_total', 'counter',
+     'Requests sent to data.world API by endpoint and status.', None),
+    ('datadotworld_rate_limited_total', 'counter',
+     'Requests rejected by data.world with 429 status.', None),
+    ('datadotworld_retries_total', 'counter',
+     'Delayed sync retries scheduled.', None),
+    ('datadotworld_request_seconds', 'histogram',
+     'Latency of data.world API requests.',
+     (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)),
+    ('datadotworld_payload_bytes', 'histogram',
+     'Size of request bodies sent to data.world API.',
+     (1000, 10000, 100000, 1000000, 10000000)),
+    ('datadotworld_sync_seconds', 'histogram',
+     'Time from enqueueing sync job to its completion.',
+     (1, 5, 15, 60, 300, 900, 3600, 21600)),
+]
+_buckets = dict((name, buckets) for name, _, _, buckets in METRICS)
+
+_buffer = {}
+_lock = threading.Lock()
+_last_flush = time.time()
+
+
+def enabled():
+    return tk.asbool(config.get('ckan.datadotworld.metrics', True))
+
+
+def _dump_labels(labels):
+    # `le` goes last, as Prometheus clients do
+    return json.dumps(sorted(
+        labels.items(), key=lambda item: (item[0] == 'le', item[0])))
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def _add(samples):
+    with _lock:
+        for name, labels, amount in samples:
+            key = (name, _dump_labels(labels))
+            _buffer[key] = _buffer.get(key, 0) + amount
+
+
+def _maybe_flush():
+    interval = config_float('ckan.datadotworld.metrics_flush_interval', 10)
+    if time.time() - _last_flush >= interval:
+        flush()
+
+
+def inc(name, amount=1, **labels):
+    """Increase counter.
+    """
+    if not enabled():
+        return
+    _add([(name, labels, amount)])
+    _maybe_flush()
+
+
+def observe(name, value, **labels):
+    """Record single value of histogram.
+    """
+    if not enabled():
+        return
+    samples = [
+        (name + '_bucket', dict(labels, le=_format_bound(bound)), 1)
+        for bound in _buckets[name] if value <= bound]
+    samples.extend([
+        (name + '_bucket', dict(labels, le='+Inf'), 1),
+        (name + '_sum', labels, value),
+        (name + '_count', labels, 1),
+    ])
+    _add(samples)
+    _maybe_flush()
+
+
+def _increment(conn, name, labels, amount):
+    table = Metric.__table__
+    where = (table.c.name == name) & (table.c.labels == labels)
+    update = table.update().where(where).values(value=table.c.value + amount)
+    if conn.execute(update).rowcount:
+        return
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(table.insert().values(
+            name=name, labels=labels, value=amount))
+        savepoint.commit()
+    except IntegrityError:
+        # row was created by another worker in the meantime
+        savepoint.rollback()
+        conn.execute(update)
+
+
+def flush():
+    """Add buffered values to shared storage.
+
+    Returns number of stored series.
+    """
+    global _buffer, _last_flush
+    with _lock:
+        pending, _buffer = _buffer, {}
+        _last_flush = time.time()
+    if not pending:
+        return 0
+
+    conn = trans = None
+    try:
+        conn = model.meta.engine.connect()
+        trans = conn.begin()
+        # same order in every worker, so concurrent flushes do not deadlock
+        for (name, labels), amount in sorted(pending.items()):
+            _increment(conn, name, labels, amount)
+        trans.commit()
+    except SQLAlchemyError as e:
+        if trans is not None:
+            trans.rollback()
+        log.warn('Metrics are not stored: {0}'.format(e))
+        return 0
+    finally:
+        if conn is not None:
+            conn.close()
+    return len(pending)
+
+
+def _escape(value):
+    return unicode(value).replace(
+        '\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        u'{0}="{1}"'.format(key, _escape(value))
+        for key, value in labels) + '}'
+
+
+def _format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _sample_order(sample):
+    labels, _ = sample
+    return [(key, float(value) if key == 'le' else value)
+            for key, value in labels]
+
+
+def render():
+    """Render stored metrics in Prometheus text format.
+    """
+    series = {}
+    for row in model.Session.query(Metric):
+        series.setdefault(row.name, []).append(
+            (json.loads(row.labels), row.value))
+
+    lines = []
+    for name, kind, help, _ in METRICS:
+        lines.append(u'# HELP {0} {1}'.format(name, help))
+        lines.append(u'# TYPE {0} {1}'.format(name, kind))
+        if kind == 'histogram':
+            names = [name + suffix for suffix in ('_bucket', '_sum', '_count')]
+        else:
+            names = [name]
+        for sample_name in names:
+            for labels, value in sorted(
+                    series.get(sample_name, []), key=_sample_order):
+                lines.append(u'{0}{1} {2}'.format(
+                    sample_name, _format_labels(labels),
+                    _format_value(value)))
+    return u'\n'.join(lines) + u'\n'
@@ -10,3 +10,10 @@ class States:
     failed = u'failed'
     pending = u'pending'
     deleted = u'deleted'
+
+
+class ValidationStates:
+    pending = u'pending'
+    valid = u'valid'
+    invalid = u'invalid'
+    error = u'error'
@@ -12,13 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+
 from ckan.model import Group
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy import (
     UnicodeText,
     ForeignKey,
     Column,
-    Boolean
+    Boolean,
+    DateTime
 )
 from ckanext.datadotworld.model import Base
 
@@ -32,16 +35,36 @@ class Credentials(Base):
     show_links = Column(Boolean)
     key = Column(UnicodeText)
     owner = Column(UnicodeText)
+    # result of the last check of owner and key against data.world
+    validated_hash = Column(UnicodeText)
+    validation_state = Column(UnicodeText)
+    validation_message = Column(UnicodeText)
+    validated_at = Column(DateTime)
 
     organization = relationship(
         Group, backref=backref(
             'datadotworld_credentials', uselist=False, cascade='all'))
 
+    editable = ('owner', 'key', 'integration', 'show_links')
+
     def update(self, data):
         for key, value in data.items():
-            if hasattr(self, key):
+            if key in self.editable:
                 setattr(self, key, value)
 
+    @staticmethod
+    def fingerprint(owner, key):
+        """Hash of owner and key, used to skip repeated checks.
+        """
+        value = u'{0}\n{1}'.format(owner or u'', key or u'')
+        return unicode(hashlib.sha256(value.encode('utf-8')).hexdigest())
+
+    @property
+    def is_validated(self):
+        """Whether current owner and key were successfully checked.
+        """
+        return self.validated_hash == self.fingerprint(self.owner, self.key)
+
     def __repr__(self):
         return '<DataDotWorld Credentials: org={0}, ownerID={1}>'.format(
             self.organization, self.owner
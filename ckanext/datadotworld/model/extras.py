@@ -17,27 +17,50 @@ from sqlalchemy.orm import relationship, backref
 from sqlalchemy import (
     UnicodeText,
     ForeignKey,
-    Column
-
+    Column,
+    Integer,
+    DateTime,
+    Index
 )
 from ckanext.datadotworld.model import Base, States
 
 
 class Extras(Base):
     __tablename__ = 'datadotworld_extras'
+    __table_args__ = (
+        Index('ix_datadotworld_extras_owner_id', 'owner', 'id'),
+        Index('ix_datadotworld_extras_owner_state', 'owner', 'state'),
+    )
 
     package_id = Column(
         UnicodeText, ForeignKey(Package.id), primary_key=True)
 
     owner = Column(UnicodeText)
     id = Column(UnicodeText)
-    state = Column(UnicodeText, default=States.uptodate)
+    state = Column(UnicodeText, default=States.uptodate, index=True)
     message = Column(UnicodeText)
+    payload_hash = Column(UnicodeText)
+    payload = Column(UnicodeText)
+    attempt = Column(Integer, default=0)
+    next_attempt = Column(DateTime, index=True)
+    # sync lag is `finished_at - enqueued_at`; enqueue is pending while
+    # `enqueued_at` is later than `finished_at`
+    enqueued_at = Column(DateTime)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    succeeded_at = Column(DateTime)
 
     package = relationship(
         Package, backref=backref(
             'datadotworld_extras', uselist=False, cascade='all'))
 
+    @property
+    def enqueue_pending(self):
+        """Whether there is enqueued change not processed yet.
+        """
+        return self.enqueued_at is not None and (
+            self.finished_at is None or self.enqueued_at > self.finished_at)
+
     def __repr__(self):
         return '<DataDotWorldExtras:pkg={0},ownerID={1},remoteID={2}>'.format(
             self.package, self.owner, self.id
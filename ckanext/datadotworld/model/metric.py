@@ -0,0 +1,33 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import (
+    UnicodeText,
+    Column,
+    Float
+)
+from ckanext.datadotworld.model import Base
+
+
+class Metric(Base):
+    __tablename__ = 'datadotworld_metrics'
+
+    name = Column(UnicodeText, primary_key=True)
+    labels = Column(UnicodeText, primary_key=True)
+    value = Column(Float, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DataDotWorldMetric:name={0},labels={1},value={2}>'.format(
+            self.name, self.labels, self.value
+        )
@@ -0,0 +1,33 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import (
+    UnicodeText,
+    Column,
+    Float
+)
+from ckanext.datadotworld.model import Base
+
+
+class RateLimit(Base):
+    __tablename__ = 'datadotworld_rate_limits'
+
+    owner = Column(UnicodeText, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated = Column(Float, nullable=False)
+
+    def __repr__(self):
+        return '<DataDotWorldRateLimit:ownerID={0},tokens={1}>'.format(
+            self.owner, self.tokens
+        )
@@ -0,0 +1,33 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import (
+    UnicodeText,
+    Column,
+    Integer
+)
+from ckanext.datadotworld.model import Base
+
+
+class StateCount(Base):
+    __tablename__ = 'datadotworld_state_counts'
+
+    organization_id = Column(UnicodeText, primary_key=True)
+    state = Column(UnicodeText, primary_key=True)
+    amount = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<DataDotWorldStateCount:org={0},state={1},amount={2}>'.format(
+            self.organization_id, self.state, self.amount
+        )
@@ -0,0 +1,53 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+
+from sqlalchemy import (
+    UnicodeText,
+    Column,
+    Integer,
+    Float,
+    DateTime,
+    Index
+)
+from ckanext.datadotworld.model import Base
+
+
+class SyncLog(Base):
+    """Append-only history of sync attempts.
+
+    Rows are not bound to package by foreign key, so history of deleted
+    and purged packages is kept until it is pruned.
+    """
+    __tablename__ = 'datadotworld_sync_log'
+    __table_args__ = (
+        Index('ix_datadotworld_sync_log_package_created',
+              'package_id', 'created'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    package_id = Column(UnicodeText, nullable=False)
+    created = Column(
+        DateTime, nullable=False, index=True,
+        default=datetime.datetime.utcnow)
+    action = Column(UnicodeText, nullable=False)
+    status = Column(Integer)
+    duration = Column(Float)
+    message = Column(UnicodeText)
+
+    def __repr__(self):
+        return '<DataDotWorldSyncLog:pkg={0},action={1},status={2}>'.format(
+            self.package_id, self.action, self.status
+        )
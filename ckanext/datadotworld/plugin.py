@@ -14,14 +14,16 @@
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
+# models are imported for their relationships(`datadotworld_credentials`,
+# `datadotworld_extras`). Sync stack(api, tasks) is intentionally not
+# imported here: it is loaded only by workers and commands.
 from ckanext.datadotworld.model.credentials import Credentials
-import ckan.model as model
+from ckanext.datadotworld.model.extras import Extras
 import logging
-import ckanext.datadotworld.tasks as tasks
-import ckanext.datadotworld.api as api
 import ckanext.datadotworld.helpers as dh
-import os
-from pylons import config
+import ckanext.datadotworld.jobs as jobs
+# registers session hook that maintains state counters
+import ckanext.datadotworld.counters as counters
 
 
 log = logging.getLogger(__name__)
@@ -37,9 +39,11 @@ class DatadotworldPlugin(plugins.SingletonPlugin):
 
     def get_helpers(self):
         return {
-            'datadotworld_link': api.API.generate_link,
-            'datadotworld_creds': api.API.creds_from_id,
-            'datadotworld_admin_in_orgs': dh.admin_in_orgs
+            'datadotworld_link': dh.datadotworld_link,
+            'datadotworld_creds': dh.datadotworld_creds,
+            'datadotworld_prefetch_creds': dh.datadotworld_prefetch_creds,
+            'datadotworld_admin_in_orgs': dh.admin_in_orgs,
+            'datadotworld_is_admin_in_orgs': dh.is_admin_in_orgs
         }
 
     # IConfigurer
@@ -62,6 +66,11 @@ class DatadotworldPlugin(plugins.SingletonPlugin):
             '/data.world/{state:failed|pending|up-to-date|deleted}',
             controller='ckanext.datadotworld.controller:DataDotWorldController',
             action='list_sync')
+        map.connect(
+            'dataworld_metrics',
+            '/data.world/metrics',
+            controller='ckanext.datadotworld.controller:DataDotWorldController',
+            action='metrics')
         map.connect(
             'list_dataworld_sync_for_org',
             '/data.world/{org_id}/{state:failed|pending|up-to-date|deleted}',
@@ -74,25 +83,13 @@ class DatadotworldPlugin(plugins.SingletonPlugin):
     # IPackageController
 
     def after_create(self, context, data_dict):
-        ckan_ini_filepath = os.path.abspath(config['__file__'])
-        api.compat_enqueue(
-            'datadotworld.syncronize',
-            tasks.syncronize,
-            args=[data_dict['id'], ckan_ini_filepath])
+        jobs.enqueue_sync(data_dict['id'])
         return data_dict
 
     def after_update(self, context, data_dict):
-        ckan_ini_filepath = os.path.abspath(config['__file__'])
-        api.compat_enqueue(
-            'datadotworld.syncronize',
-            tasks.syncronize,
-            args=[data_dict['id'], ckan_ini_filepath])
+        jobs.enqueue_sync(data_dict['id'])
         return data_dict
 
     def after_delete(self, context, data_dict):
-        ckan_ini_filepath = os.path.abspath(config['__file__'])
-        api.compat_enqueue(
-            'datadotworld.syncronize',
-            tasks.syncronize,
-            args=[data_dict['id'], ckan_ini_filepath])
+        jobs.enqueue_sync(data_dict['id'])
         return data_dict
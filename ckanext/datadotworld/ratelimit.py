@@ -0,0 +1,139 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Token-bucket rate limiter for data.world requests.
+
+Bucket state is kept in `datadotworld_rate_limits` table, one row per
+data.world owner, so every worker process on every host that shares CKAN
+database draws tokens from the same bucket. Row is locked while tokens are
+taken, which serializes concurrent workers. Workers use their local clocks
+for refill, so hosts are expected to be time-synchronized.
+"""
+
+import time
+import logging
+
+from pylons import config
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+import ckan.model as model
+from ckanext.datadotworld.model.rate_limit import RateLimit
+from ckanext.datadotworld.helpers import config_float
+
+log = logging.getLogger(__name__)
+
+
+class RateLimitTimeout(Exception):
+    pass
+
+
+def get_rate():
+    """Allowed number of requests per second for single owner.
+
+    Falls back to deprecated `request_delay` option when rate is not
+    configured explicitly.
+    """
+    if 'ckan.datadotworld.rate_limit' in config:
+        return config_float('ckan.datadotworld.rate_limit', 1.0)
+    delay = config_float('ckan.datadotworld.request_delay', 1.0)
+    if delay <= 0:
+        return 0
+    return 1.0 / delay
+
+
+def get_burst():
+    return max(1.0, config_float('ckan.datadotworld.rate_burst', 1.0))
+
+
+def _take_once(owner, rate, burst):
+    """Single attempt to take token from owner's bucket.
+
+    Returns None if bucket was created concurrently by another worker.
+    """
+    table = RateLimit.__table__
+    conn = trans = None
+    try:
+        conn = model.meta.engine.connect()
+        trans = conn.begin()
+        now = time.time()
+        row = conn.execute(
+            select([table]).where(table.c.owner == owner).with_for_update()
+        ).first()
+        if row is None:
+            conn.execute(table.insert().values(
+                owner=owner, tokens=burst - 1, updated=now))
+            trans.commit()
+            return 0
+
+        elapsed = max(0, now - row.updated)
+        tokens = min(burst, row.tokens + elapsed * rate)
+        if tokens >= 1:
+            tokens -= 1
+            wait = 0
+        else:
+            wait = (1 - tokens) / rate
+        conn.execute(table.update().where(table.c.owner == owner).values(
+            tokens=tokens, updated=now))
+        trans.commit()
+        return wait
+    except IntegrityError:
+        trans.rollback()
+        return None
+    except SQLAlchemyError as e:
+        if trans is not None:
+            trans.rollback()
+        log.warn('Rate limiter is not available: {0}'.format(e))
+        return 0
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def _take(owner, rate, burst, attempts=3):
+    """Try to take single token from owner's bucket.
+
+    Returns number of seconds to wait before next attempt or 0 if token
+    was taken. Limiter fails open: if database is not available or bucket
+    cannot be created, request is allowed.
+    """
+    for attempt in range(attempts):
+        wait = _take_once(owner, rate, burst)
+        if wait is not None:
+            return wait
+        # bucket was created by another worker in the meantime
+        time.sleep(0.01)
+    log.warn('Cannot create rate limiter bucket for {0}'.format(owner))
+    return 0
+
+
+def acquire(owner, timeout=None):
+    """Block until request on behalf of owner is allowed.
+
+    With `timeout`, RateLimitTimeout is raised instead of waiting for
+    longer than `timeout` seconds.
+    """
+    rate = get_rate()
+    if rate <= 0:
+        return
+    burst = get_burst()
+    deadline = None if timeout is None else time.time() + timeout
+    wait = _take(owner, rate, burst)
+    while wait:
+        if deadline is not None and time.time() + wait > deadline:
+            raise RateLimitTimeout(
+                'Rate limit of {0} is exhausted, try again later'.format(
+                    owner))
+        time.sleep(wait)
+        wait = _take(owner, rate, burst)
@@ -13,9 +13,20 @@
 # limitations under the License.
 
 from ckan.lib.celery_app import celery
-from ckanext.datadotworld.api import syncronize
+from ckanext.datadotworld.api import (
+    syncronize, syncronize_batch, validate_credentials)
 
 
 @celery.task(name="datadotworld.syncronize")
 def datadotworld_syncronize(*args, **kwargs):
     syncronize(*args, **kwargs)
+
+
+@celery.task(name="datadotworld.syncronize_batch")
+def datadotworld_syncronize_batch(*args, **kwargs):
+    syncronize_batch(*args, **kwargs)
+
+
+@celery.task(name="datadotworld.validate_credentials")
+def datadotworld_validate_credentials(*args, **kwargs):
+    validate_credentials(*args, **kwargs)
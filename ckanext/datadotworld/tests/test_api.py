@@ -17,16 +17,31 @@ import ckan.model as model
 from ckan.tests.factories import Dataset, Organization, User
 from ckanext.datadotworld.model.credentials import Credentials
 from ckanext.datadotworld.model.extras import Extras
+from ckanext.datadotworld.model.sync_log import SyncLog
 import ckanext.datadotworld.api as api
+import ckanext.datadotworld.ratelimit as ratelimit
+import ckanext.datadotworld.metrics as metrics
+import ckanext.datadotworld.jobs as jobs
+import ckanext.datadotworld.counters as counters
+import ckanext.datadotworld.helpers as dh
 from ckan.tests.helpers import (
-    reset_db
+    reset_db,
+    _get_test_app
 )
-from ckanext.datadotworld.model import States
+from ckanext.datadotworld.model import States, ValidationStates
 from json import dumps, loads
-from ckanext.datadotworld.command import DataDotWorldCommand
+from ckanext.datadotworld.command import DataDotWorldCommand, _run_bulk
+from ckanext.datadotworld.controller import DataDotWorldController
 import mock
+import requests
+from sqlalchemy import inspect, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
 from unittest import TestCase
 import os.path as path
+import time
+import threading
+import datetime
 
 API = api.API
 
@@ -35,9 +50,10 @@ cmd = DataDotWorldCommand(None)
 
 
 class Response:
-    def __init__(self, status_code=200, content={}):
+    def __init__(self, status_code=200, content={}, headers={}):
         self.status_code = status_code
         self.content = dumps(content)
+        self.headers = headers
 
     def json(self):
         return loads(self.content)
@@ -61,6 +77,18 @@ class TestAPI(TestCase):
         self.assertIn('ignore_auth', context)
         self.assertTrue(context['ignore_auth'])
 
+    @mock.patch('ckan.config.environment.load_environment')
+    def test_load_config(self, load_environment):
+        ini = api.config['__file__']
+        api._loaded_config.clear()
+        api.load_config(ini)
+        self.assertFalse(load_environment.called)
+
+        api._loaded_config[ini] = (0, 0)
+        api.load_config(ini)
+        api.load_config(ini)
+        self.assertEqual(1, load_environment.call_count)
+
     def test_dataworld_name(self):
         self.assertEqual('name', api.dataworld_name('NaMe'))
         self.assertEqual('n-a-m-e', api.dataworld_name('  n  a  m  e  '))
@@ -84,6 +112,18 @@ class TestAPI(TestCase):
             {'name': u'invalid tag'}]
         self.assertEqual(3, len(api.datadotworld_tags_name_normalize(tags_list)))
 
+    def test_tags_cache(self):
+        api._tags_cache.clear()
+        tags_list = [{'name': u'Tag_One'}, {'name': u'x'}, {'name': u'Tag_One'}]
+        self.assertEqual(
+            ['tag one'], api.datadotworld_tags_name_normalize(tags_list))
+        self.assertEqual(
+            ['tag one'], api.datadotworld_tags_name_normalize(tags_list))
+        info = api.tags_cache_info()
+        self.assertEqual(2, info['misses'])
+        self.assertEqual(4, info['hits'])
+        self.assertEqual(2, info['size'])
+
     def test_get_creds_if_must_sync(self):
         pkg = Dataset()
         creds = api._get_creds_if_must_sync(pkg)
@@ -93,12 +133,14 @@ class TestAPI(TestCase):
         creds = api._get_creds_if_must_sync(pkg)
         self.assertNotEqual(None, creds)
 
-        old_creds = creds
-        creds.integration = False
-        creds = api._get_creds_if_must_sync(pkg)
+        self.creds.integration = False
+        model.Session.commit()
+        creds = api._get_creds_if_must_sync(pkg, fresh=True)
         self.assertEqual(None, creds)
 
-        old_creds.integration = True
+        self.creds.integration = True
+        model.Session.commit()
+        dh.invalidate_creds(self.org['id'])
 
     @mock.patch(api.__name__ + '.API.sync')
     def test_notify(self, sync):
@@ -117,7 +159,36 @@ class TestAPI(TestCase):
         pkg = Dataset(owner_org=self.org['id'])
         attempt = 0
         self.assertTrue(api.notify(pkg['id']))
-        sync.assert_called_with(pkg, attempt)
+        sync.assert_called_with(pkg, attempt, force=False, enqueued=None)
+
+    @mock.patch(api.__name__ + '.compat_enqueue')
+    def test_enqueue_batches(self, enqueue):
+        with mock.patch(api.__name__ + '.config_int', return_value=2):
+            amount = api.enqueue_batches(['a', 'b', 'c'], force=True)
+        self.assertEqual(2, amount)
+        self.assertEqual(2, enqueue.call_count)
+        batches = [call[1]['args'] for call in enqueue.call_args_list]
+        self.assertEqual(['a', 'b'], batches[0][0])
+        self.assertEqual(['c'], batches[1][0])
+        self.assertTrue(batches[0][2])
+
+    @mock.patch(api.__name__ + '.release_retries')
+    @mock.patch(api.__name__ + '.notify')
+    def test_syncronize_batch(self, notify, release_retries):
+        notify.side_effect = [ValueError('boom'), True]
+        with mock.patch(api.__name__ + '.load_config'):
+            api.syncronize_batch(['a', 'b'], 'config.ini')
+        notify.assert_called_with('b', force=False, enqueued=None)
+        self.assertEqual(2, notify.call_count)
+        self.assertTrue(release_retries.called)
+
+    @mock.patch(api.__name__ + '.release_retries')
+    @mock.patch(api.__name__ + '.notify')
+    def test_syncronize_releases_retries(self, notify, release_retries):
+        release_retries.side_effect = ValueError('boom')
+        with mock.patch(api.__name__ + '.load_config'):
+            api.syncronize('a', 'config.ini')
+        self.assertTrue(release_retries.called)
 
     def test_prepare_resource_url(self):
         res = {'url': 'a/b/c.csv', 'name': 'File'}
@@ -185,9 +256,147 @@ class TestAPI(TestCase):
         self.assertEqual(API.root + '/x', API.generate_link('x'))
         self.assertEqual(API.root + '/x/y', API.generate_link('x', 'y'))
 
+    def test_use_api_root(self):
+        client = API('owner', 'key')
+        client._use_api_root('http://localhost:8765/v0')
+        self.assertEqual(
+            'http://localhost:8765/v0/datasets/owner/x/sync',
+            client.api_res_sync.format(owner='owner', name='x'))
+        self.assertEqual(
+            'https://api.data.world/v0/datasets/owner/x/sync',
+            self.api.api_res_sync.format(owner='owner', name='x'))
+
     def test_creds_from_id(self):
         self.assertEqual(None, API.creds_from_id('x'))
-        self.assertEqual(self.creds, API.creds_from_id(self.org['id']))
+        creds = API.creds_from_id(self.org['id'])
+        self.assertEqual(
+            (self.creds.owner, self.creds.key),
+            (creds.owner, creds.key))
+
+    def test_creds_cache(self):
+        org = Organization()
+        creds = Credentials(
+            organization_id=org['id'], integration=True,
+            owner='cached-owner', key='key')
+        model.Session.add(creds)
+        model.Session.commit()
+        get = dh.datadotworld_creds
+        self.assertEqual('cached-owner', get(org['id']).owner)
+
+        creds.owner = 'new-owner'
+        model.Session.commit()
+        self.assertEqual('cached-owner', get(org['id']).owner)
+        self.assertEqual('new-owner', get(org['id'], fresh=True).owner)
+
+        creds.owner = 'newest-owner'
+        model.Session.commit()
+        dh.invalidate_creds(org['id'])
+        self.assertEqual('newest-owner', get(org['id']).owner)
+
+        dh.invalidate_creds(org['id'])
+        with mock.patch(dh.__name__ + '.config_int', return_value=0):
+            get(org['id'])
+        missing = object()
+        self.assertIs(missing, dh._creds_cache.get(org['id'], missing))
+
+    def test_prefetch_creds(self):
+        model.repo.new_revision()
+        ids = []
+        for i in range(100):
+            org = model.Group(
+                name='prefetch-org-{0}'.format(i), type='organization',
+                is_organization=True)
+            model.Session.add(org)
+            model.Session.flush()
+            ids.append(org.id)
+            if i % 2:
+                model.Session.add(Credentials(
+                    organization_id=org.id, integration=True,
+                    owner='prefetch-{0}'.format(i), key='key'))
+        model.Session.commit()
+
+        statements = []
+
+        def count(*args, **kwargs):
+            statements.append(args[2])
+        event.listen(model.meta.engine, 'before_cursor_execute', count)
+        try:
+            dh.datadotworld_prefetch_creds(ids)
+            found = [dh.datadotworld_creds(id) for id in ids]
+            dh.datadotworld_prefetch_creds(ids)
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count)
+        self.assertEqual(1, len(statements), statements)
+        self.assertEqual(None, found[0])
+        self.assertEqual('prefetch-1', found[1].owner)
+
+    def test_listing_does_not_read_creds(self):
+        model.repo.new_revision()
+        for i in range(100):
+            org = model.Group(
+                name='listing-org-{0}'.format(i), type='organization',
+                is_organization=True)
+            model.Session.add(org)
+            model.Session.flush()
+            model.Session.add(Credentials(
+                organization_id=org.id, integration=True,
+                owner='listing-{0}'.format(i), key='key'))
+        model.Session.commit()
+
+        app = _get_test_app()
+        statements = []
+
+        def count(*args, **kwargs):
+            statements.append(args[2])
+        event.listen(model.meta.engine, 'before_cursor_execute', count)
+        try:
+            app.get('/organization')
+            app.get('/dataset')
+        finally:
+            event.remove(model.meta.engine, 'before_cursor_execute', count)
+        self.assertTrue(statements)
+        self.assertEqual([], [
+            statement for statement in statements
+            if 'datadotworld_credentials' in statement])
+
+    def test_request_creds_cache(self):
+        class Context(object):
+            pass
+        with mock.patch(dh.__name__ + '.tmpl_context', Context()):
+            # commands and jobs register context, but not web request
+            with mock.patch(dh.__name__ + '.request', mock.Mock(environ={})):
+                self.assertEqual(None, dh._request_creds_cache())
+            request = mock.Mock(environ={'PATH_INFO': '/dataset'})
+            with mock.patch(dh.__name__ + '.request', request):
+                cache = dh._request_creds_cache()
+                self.assertEqual({}, cache)
+                self.assertIs(cache, dh._request_creds_cache())
+
+    def test_admin_cache(self):
+        admin = User()
+        other = User()
+        org = Organization(users=[
+            {'capacity': 'admin', 'name': admin['name']}
+        ])
+        self.assertTrue(dh.is_admin_in_orgs(admin['name']))
+        self.assertIn(org['id'], dh.admin_org_ids(admin['name']))
+        self.assertEqual(
+            [org['id']], [o.id for o in dh.admin_in_orgs(admin['name'])])
+        self.assertFalse(dh.is_admin_in_orgs(other['name']))
+        self.assertEqual((), dh.admin_org_ids(other['name']))
+
+        with mock.patch(dh.__name__ + '._admin_memberships') as query:
+            self.assertTrue(dh.is_admin_in_orgs(admin['name']))
+            self.assertFalse(query.called)
+
+        # membership change clears cache once committed
+        model.repo.new_revision()
+        model.Session.add(model.Member(
+            table_name='user', table_id=other['id'], group_id=org['id'],
+            capacity='admin', state='active'))
+        model.Session.commit()
+        self.assertTrue(dh.is_admin_in_orgs(other['name']))
+        self.assertEqual((org['id'],), dh.admin_org_ids(other['name']))
 
     def test_default_headers(self):
         headers = self.api._default_headers()
@@ -198,27 +407,33 @@ class TestAPI(TestCase):
         key = API.auth.format(key=self.creds.key)
         self.assertEqual(key, headers['Authorization'])
 
-    @mock.patch('requests.get')
+    def test_get_session(self):
+        session = api.get_session('owner', 'key')
+        self.assertIs(session, api.get_session('owner', 'key'))
+        self.assertIs(session, API('owner', 'key').session)
+        self.assertIsNot(session, api.get_session('owner', 'other-key'))
+
+    @mock.patch('requests.Session.get')
     def test_get(self, get):
         self.api._get('url')
         headers = self.api._default_headers()
         get.assert_called_once_with(url='url', headers=headers)
 
-    @mock.patch('requests.post')
+    @mock.patch('requests.Session.post')
     def test_post(self, post):
         self.api._post('url', {'a': 1})
         headers = self.api._default_headers()
         data = '{"a": 1}'
         post.assert_called_once_with(url='url', headers=headers, data=data)
 
-    @mock.patch('requests.put')
+    @mock.patch('requests.Session.put')
     def test_put(self, put):
         self.api._put('url', {'a': 1})
         headers = self.api._default_headers()
         data = '{"a": 1}'
         put.assert_called_once_with(url='url', headers=headers, data=data)
 
-    @mock.patch('requests.delete')
+    @mock.patch('requests.Session.delete')
     def test_delete(self, delete):
         self.api._delete('url', {'a': 1})
         headers = self.api._default_headers()
@@ -238,6 +453,49 @@ class TestAPI(TestCase):
             'summary': pkg['notes'] + api.dataset_footnote(pkg)}
         self.assertEqual(expect, result)
 
+    def test_dataset_footnote(self):
+        from ckan.lib.helpers import (
+            url_for, date_str_to_datetime, render_datetime)
+        pkg = Dataset()
+        expect = '\n\nSource: {0}  \r\nLast updated at {1} : {2}'.format(
+            url_for(controller='package', action='read', id=pkg['id'],
+                    qualified=True),
+            url_for(controller='home', action='index', qualified=True),
+            render_datetime(
+                date_str_to_datetime(pkg['metadata_modified']), '%Y-%m-%d'))
+        self.assertEqual(expect, api.dataset_footnote(pkg))
+        self.assertEqual(expect, api.PayloadBuilder().footnote(pkg))
+        self.assertIs(api.get_payload_builder(), api.get_payload_builder())
+
+    def test_payload_hash(self):
+        data = {'title': 'x', 'tags': ['a', 'b'], 'files': []}
+        fingerprint = api.payload_hash(data)
+        self.assertEqual(
+            fingerprint, api.payload_hash(dict(data, tags=['b', 'a'])))
+        self.assertNotEqual(
+            fingerprint, api.payload_hash(dict(data, title='y')))
+
+    def test_retry_delay(self):
+        res = Response(429, headers={'Retry-After': '30'})
+        self.assertEqual(30, api._retry_delay(res, 5))
+
+        res = Response(429)
+        for attempt in range(5):
+            delay = api._retry_delay(res, attempt)
+            self.assertTrue(0 <= delay <= 2 * 2 ** attempt)
+        self.assertTrue(api._retry_delay(res, 100) <= 600)
+
+    def test_repeat_request(self):
+        extras = Extras(id='id', state=States.uptodate)
+        api._repeat_request(extras, Response(429), 0)
+        self.assertEqual(1, extras.attempt)
+        self.assertEqual(States.pending, extras.state)
+        self.assertNotEqual(None, extras.next_attempt)
+
+        api._repeat_request(extras, Response(429), 100)
+        self.assertEqual(States.failed, extras.state)
+        self.assertEqual(None, extras.next_attempt)
+
     def test_is_dict_changed(self):
         old = {'x': [{'e': 0}]}
         new = {'x': [{'e': 1}]}
@@ -252,12 +510,12 @@ class TestAPI(TestCase):
 
         method.return_value = Response()
         self.api._create_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'create')
 
         method.reset_mock()
         method.return_value = Response(404)
         self.api._create_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'create')
 
     @mock.patch(api.__name__ + '.API._put')
     def test_update_request(self, method):
@@ -266,12 +524,12 @@ class TestAPI(TestCase):
 
         method.return_value = Response()
         self.api._update_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'update')
 
         method.reset_mock()
         method.return_value = Response(404)
         self.api._update_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'update')
 
     @mock.patch(api.__name__ + '.API._get')
     def test_is_update_required(self, method):
@@ -280,19 +538,19 @@ class TestAPI(TestCase):
 
         method.return_value = Response(200, data)
         check = self.api._is_update_required(data, 'id')
-        method.assert_called_once_with(url)
+        method.assert_called_once_with(url, 'dirty_check')
         self.assertFalse(check)
 
         method.reset_mock()
         method.return_value = Response(200, {'x': 2})
         check = self.api._is_update_required(data, 'id')
-        method.assert_called_once_with(url)
+        method.assert_called_once_with(url, 'dirty_check')
         self.assertTrue(check)
 
         method.reset_mock()
         method.return_value = Response(404)
         check = self.api._is_update_required(data, 'id')
-        method.assert_called_once_with(url)
+        method.assert_called_once_with(url, 'dirty_check')
         self.assertTrue(check)
 
     @mock.patch(api.__name__ + '.API._delete')
@@ -302,12 +560,12 @@ class TestAPI(TestCase):
 
         method.return_value = Response()
         self.api._delete_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'delete')
 
         method.reset_mock()
         method.return_value = Response(404)
         self.api._delete_request(data, 'id')
-        method.assert_called_once_with(url, data)
+        method.assert_called_once_with(url, data, 'delete')
 
     @mock.patch(api.__name__ + '.API._create_request')
     def test_create(self, create):
@@ -348,6 +606,8 @@ class TestAPI(TestCase):
         self.assertEqual(data, result)
         self.assertEqual('id', extras.id)
         self.assertEqual(States.pending, extras.state)
+        self.assertEqual(1, extras.attempt)
+        self.assertNotEqual(None, extras.next_attempt)
 
     @mock.patch(api.__name__ + '.API._is_update_required')
     @mock.patch(api.__name__ + '.API._create_request')
@@ -357,18 +617,27 @@ class TestAPI(TestCase):
         extras = Extras(id='id')
 
         update_required.return_value = False
-        self.api._update(data, extras)
+        self.api._update(data, extras, force=True)
         self.assertEqual(None, extras.message)
-        update_required.return_value = True
+        self.assertEqual(States.uptodate, extras.state)
+        self.assertEqual(api.payload_hash(data), extras.payload_hash)
+
+        update_required.reset_mock()
+        self.api._update(data, extras)
+        self.assertFalse(update_required.called)
+        self.assertFalse(update.called)
 
+        extras.payload_hash = None
         update.return_value = Response(200, data)
         result = self.api._update(data, extras)
         update.assert_called_once_with(data, 'id')
         self.assertEqual(data, result)
         self.assertEqual(dumps(data), extras.message)
         self.assertEqual(States.uptodate, extras.state)
+        self.assertEqual(api.payload_hash(data), extras.payload_hash)
 
         extras.state = States.pending
+        extras.payload_hash = None
         update.reset_mock()
         update.return_value = Response(404, data)
         create.return_value = Response(200, data)
@@ -379,6 +648,7 @@ class TestAPI(TestCase):
         self.assertEqual(States.uptodate, extras.state)
 
         extras.state = States.pending
+        extras.payload_hash = None
         extras.id = 'id'
         update.reset_mock()
         create.reset_mock()
@@ -406,6 +676,78 @@ class TestAPI(TestCase):
         self.assertEqual(data, result)
         self.assertEqual(States.pending, extras.state)
 
+    @mock.patch(api.__name__ + '.API._delete')
+    @mock.patch(api.__name__ + '.API._post')
+    def test_files_request(self, post, delete):
+        a = {'name': 'a.csv', 'source': {'url': 'a'}}
+        b = {'name': 'b.csv', 'source': {'url': 'b'}}
+        c = {'name': 'c.csv', 'source': {'url': 'c'}}
+        baseline = {'files': [a, b]}
+
+        self.assertEqual(
+            None, self.api._files_request({'files': [a, b]}, baseline, 'id'))
+        self.assertFalse(post.called)
+        self.assertFalse(delete.called)
+
+        post.return_value = Response(200)
+        delete.return_value = Response(200)
+        changed_b = dict(b, source={'url': 'new-b'})
+        res = self.api._files_request(
+            {'files': [changed_b, c]}, baseline, 'id')
+        self.assertEqual(200, res.status_code)
+        url = self.api.api_res_create.format(owner='owner', name='id')
+        post.assert_called_once_with(
+            url, {'files': [changed_b, c]}, 'files')
+        url = self.api.api_res_delete.format(
+            owner='owner', name='id', file='a.csv')
+        delete.assert_called_once_with(url, {}, 'file_delete')
+
+        self.assertEqual(
+            None, self.api._files_request({'files': [a, a]}, baseline, 'id'))
+
+    @mock.patch('requests.Session.patch')
+    def test_patch(self, patch):
+        self.api._patch('url', {'a': 1})
+        headers = self.api._default_headers()
+        data = '{"a": 1}'
+        patch.assert_called_once_with(url='url', headers=headers, data=data)
+
+    def test_payload_diff(self):
+        baseline = {'title': 'x', 'tags': ['a', 'b'], 'summary': 's'}
+        data = dict(baseline, tags=['b', 'a'], summary='new')
+        self.assertEqual({'summary': 'new'}, api._payload_diff(data, baseline))
+
+    @mock.patch(api.__name__ + '.API._patch_request')
+    @mock.patch(api.__name__ + '.API._update_request')
+    def test_send_update(self, update, patch):
+        a = {'name': 'a.csv', 'source': {'url': 'a'}}
+        b = {'name': 'b.csv', 'source': {'url': 'b'}}
+        baseline = {'title': 'x', 'summary': 's', 'tags': [], 'files': [a]}
+        patch.return_value = Response(200)
+        update.return_value = Response(200)
+
+        data = dict(baseline, summary='new')
+        self.api._send_update(data, 'id')
+        update.assert_called_once_with(data, 'id')
+        self.assertFalse(patch.called)
+
+        update.reset_mock()
+        self.api._send_update(data, 'id', baseline)
+        patch.assert_called_once_with({'summary': 'new'}, 'id')
+        self.assertFalse(update.called)
+
+        patch.reset_mock()
+        data = dict(baseline, files=[a, b])
+        self.api._send_update(data, 'id', baseline)
+        patch.assert_called_once_with({'files': [b]}, 'id')
+        self.assertFalse(update.called)
+
+        patch.reset_mock()
+        data = dict(baseline, files=[b])
+        self.api._send_update(data, 'id', baseline)
+        update.assert_called_once_with(data, 'id')
+        self.assertFalse(patch.called)
+
     @mock.patch(api.__name__ + '.API._delete_request')
     def test_delete_dataset(self, delete):
         data = {'uri': 'xxx'}
@@ -452,11 +794,97 @@ class TestAPI(TestCase):
         self.assertFalse(create.called)
         self.assertFalse(update.called)
 
+    @mock.patch(api.__name__ + '.API._update_request')
+    @mock.patch(api.__name__ + '.API._create_request')
+    def test_sync_deferred(self, create, update):
+        pkg = Dataset()
+        create.return_value = Response(200, {})
+        send, finish = self.api.sync_deferred(pkg)
+        self.assertFalse(create.called)
+        self.assertTrue(finish(send()))
+        extras = model.Package.get(pkg['id']).datadotworld_extras
+        self.assertEqual(States.uptodate, extras.state)
+
+        send, finish = self.api.sync_deferred(pkg)
+        self.assertEqual(None, send())
+        self.assertFalse(update.called)
+        self.assertTrue(finish(None))
+
+    @mock.patch(api.__name__ + '.API._create_request')
+    def test_sync_timestamps(self, create):
+        pkg = Dataset()
+        create.return_value = Response(200, {})
+        enqueued = time.time() - 5
+        self.api.sync(pkg, enqueued=enqueued)
+        extras = model.Package.get(pkg['id']).datadotworld_extras
+        self.assertEqual(
+            datetime.datetime.utcfromtimestamp(enqueued), extras.enqueued_at)
+        self.assertLessEqual(extras.enqueued_at, extras.started_at)
+        self.assertLessEqual(extras.started_at, extras.finished_at)
+        self.assertEqual(extras.finished_at, extras.succeeded_at)
+        self.assertFalse(extras.enqueue_pending)
+
+        # first pending change is kept
+        jobs.mark_enqueued(pkg['id'], time.time())
+        model.Session.commit()
+        model.Session.refresh(extras)
+        first = extras.enqueued_at
+        self.assertTrue(extras.enqueue_pending)
+        jobs.mark_enqueued(pkg['id'], time.time() + 10)
+        model.Session.commit()
+        model.Session.refresh(extras)
+        self.assertEqual(first, extras.enqueued_at)
+
+        # failed sync finishes, but does not succeed
+        succeeded = extras.succeeded_at
+        with mock.patch(api.__name__ + '.API._update_request') as update:
+            update.return_value = Response(500, {})
+            self.api.sync(pkg, force=True)
+        self.assertEqual(first, extras.enqueued_at)
+        self.assertEqual(States.failed, extras.state)
+        self.assertEqual(succeeded, extras.succeeded_at)
+        self.assertGreater(extras.finished_at, succeeded)
+
+    def test_result_summary(self):
+        self.assertEqual(
+            dumps({'a': 1}), api._result_summary(dumps({'a': 1})))
+        summary = loads(api._result_summary(dumps({
+            'message': 'x' * 1000, 'details': ['y'] * 1000})))
+        self.assertEqual('x' * 200 + '...', summary['message'])
+        self.assertEqual(203, len(summary['details']))
+        self.assertEqual('<html>', api._result_summary('<html>'))
+        self.assertEqual(203, len(api._result_summary('z' * 1000)))
+
+    @mock.patch(api.__name__ + '.API._update_request')
+    @mock.patch(api.__name__ + '.API._create_request')
+    def test_sync_log(self, create, update):
+        pkg = Dataset()
+        create.return_value = Response(500, {'message': 'x' * 5000})
+        self.api.sync(pkg)
+        update.return_value = Response(404, {})
+        create.return_value = Response(200, {})
+        self.api.sync(pkg)
+
+        log = model.Session.query(SyncLog).filter_by(
+            package_id=pkg['id']).order_by(SyncLog.id).all()
+        self.assertEqual(
+            [('create', 500), ('update', 404), ('create', 200)],
+            [(entry.action, entry.status) for entry in log])
+        self.assertEqual(1003, len(log[0].message))
+        self.assertIsNotNone(log[0].duration)
+
+        log[0].created = datetime.datetime.utcnow() - datetime.timedelta(
+            days=40)
+        model.Session.commit()
+        self.assertEqual(1, api.prune_sync_log(30))
+        self.assertEqual(2, model.Session.query(SyncLog).filter_by(
+            package_id=pkg['id']).count())
+
     @mock.patch(api.__name__ + '.API._get')
     def test_sync_resources(self, get):
         url = 'https://api.data.world/v0/datasets/owner/x/sync'
         self.api.sync_resources('x')
-        get.assert_called_once_with(url)
+        get.assert_called_once_with(url, 'sync_resources')
 
     @mock.patch(api.__name__ + '.API._get')
     def test_check_credentials(self, get):
@@ -469,6 +897,110 @@ class TestAPI(TestCase):
         check = self.api.check_credentials()
         self.assertFalse(check)
 
+    @mock.patch(api.__name__ + '.API.check_credentials')
+    def test_check_credentials_cache(self, check):
+        creds = Credentials(owner='check-owner', key='key')
+        check.return_value = False
+        self.assertEqual(
+            ValidationStates.invalid, api.check_credentials(creds))
+        self.assertFalse(creds.is_validated)
+
+        check.return_value = True
+        self.assertEqual(ValidationStates.valid, api.check_credentials(creds))
+        self.assertTrue(creds.is_validated)
+        check.reset_mock()
+        self.assertEqual(ValidationStates.valid, api.check_credentials(creds))
+        self.assertFalse(check.called)
+
+        creds.key = 'other-key'
+        check.side_effect = requests.Timeout('timed out')
+        self.assertEqual(ValidationStates.error, api.check_credentials(creds))
+        self.assertEqual('timed out', creds.validation_message)
+        self.assertFalse(creds.is_validated)
+
+    @mock.patch(ratelimit.__name__ + '.get_rate')
+    @mock.patch(ratelimit.__name__ + '._take')
+    @mock.patch(api.__name__ + '.config_float')
+    def test_check_credentials_rate_limited(self, config_float, take,
+                                            get_rate):
+        config_float.return_value = 1
+        get_rate.return_value = 1
+        take.return_value = 5
+        creds = Credentials(owner='limited-owner', key='key')
+        with mock.patch('requests.Session.get') as get:
+            state = api.check_credentials(creds)
+        self.assertFalse(get.called)
+        self.assertEqual(ValidationStates.error, state)
+        self.assertIn('limited-owner', creds.validation_message)
+
+    @mock.patch(api.__name__ + '.enqueue_batches')
+    @mock.patch(api.__name__ + '.API.check_credentials')
+    def test_failed_validation_keeps_states(self, check, enqueue_batches):
+        org = Organization()
+        pkg = Dataset(owner_org=org['id'])
+        model.Session.add(Credentials(
+            organization_id=org['id'], integration=True,
+            owner='invalid-owner', key='key',
+            validation_state=ValidationStates.pending))
+        model.Session.add(Extras(
+            package_id=pkg['id'], owner='invalid-owner', id=pkg['name'],
+            state=States.uptodate))
+        model.Session.commit()
+
+        check.return_value = False
+        with mock.patch(api.__name__ + '.load_config'):
+            api.validate_credentials(org['id'], 'config.ini')
+        extras = model.Package.get(pkg['id']).datadotworld_extras
+        self.assertEqual(States.uptodate, extras.state)
+        self.assertFalse(enqueue_batches.called)
+
+        api.syncronize_org(org['id'])
+        self.assertEqual(States.pending, extras.state)
+        self.assertTrue(enqueue_batches.called)
+
+    @mock.patch(api.__name__ + '.syncronize_org')
+    @mock.patch(api.__name__ + '.API.check_credentials')
+    def test_validate_credentials(self, check, syncronize_org):
+        org = Organization()
+        model.Session.add(Credentials(
+            organization_id=org['id'], integration=True,
+            owner='validate-owner', key='key',
+            validation_state=ValidationStates.pending))
+        model.Session.commit()
+
+        check.return_value = True
+        with mock.patch(api.__name__ + '.load_config'):
+            api.validate_credentials(org['id'], 'config.ini')
+        creds = model.Group.get(org['id']).datadotworld_credentials
+        self.assertEqual(ValidationStates.valid, creds.validation_state)
+        self.assertTrue(creds.is_validated)
+        syncronize_org.assert_called_once_with(org['id'])
+
+        # credentials changed during the check
+        creds.key = 'new-key'
+        model.Session.commit()
+        syncronize_org.reset_mock()
+
+        def change_key(timeout=None):
+            model.Session.execute(
+                Credentials.__table__.update().where(
+                    Credentials.organization_id == org['id']
+                ).values(key='newest-key'))
+            model.Session.commit()
+            return True
+        check.side_effect = change_key
+        with mock.patch(api.__name__ + '.load_config'):
+            api.validate_credentials(org['id'], 'config.ini')
+        self.assertEqual('newest-key', creds.key)
+        self.assertFalse(creds.is_validated)
+        self.assertFalse(syncronize_org.called)
+
+    def test_credentials_update(self):
+        creds = Credentials()
+        creds.update({'owner': 'x', 'validated_hash': 'y'})
+        self.assertEqual('x', creds.owner)
+        self.assertEqual(None, creds.validated_hash)
+
     @classmethod
     def setUpClass(cls):
         user = User()
@@ -487,3 +1019,350 @@ class TestAPI(TestCase):
         cls.creds = creds
         cls.user = user
         cls.api = api.API(creds.owner, creds.key)
+
+
+class TestRateLimit(TestCase):
+
+    def test_take(self):
+        owner = 'rate-limit-owner'
+        self.assertEqual(0, ratelimit._take(owner, 1, 2))
+        self.assertEqual(0, ratelimit._take(owner, 1, 2))
+        self.assertGreater(ratelimit._take(owner, 1, 2), 0)
+
+    @mock.patch('ckan.model.meta.engine')
+    def test_take_fails_open(self, engine):
+        engine.connect.side_effect = OperationalError(
+            'connect', {}, Exception('pool timeout'))
+        self.assertEqual(0, ratelimit._take('rate-limit-owner', 1, 1))
+
+    @mock.patch(ratelimit.__name__ + '.time.sleep')
+    @mock.patch(ratelimit.__name__ + '._take_once')
+    def test_take_limits_conflicts(self, take_once, sleep):
+        take_once.return_value = None
+        self.assertEqual(0, ratelimit._take('owner', 1, 1))
+        self.assertEqual(3, take_once.call_count)
+
+    @mock.patch(ratelimit.__name__ + '.get_rate')
+    @mock.patch(ratelimit.__name__ + '._take')
+    def test_acquire(self, take, get_rate):
+        get_rate.return_value = 0
+        ratelimit.acquire('owner')
+        self.assertFalse(take.called)
+
+        get_rate.return_value = 1
+        take.side_effect = [0.01, 0]
+        ratelimit.acquire('owner')
+        self.assertEqual(2, take.call_count)
+
+        take.reset_mock()
+        take.side_effect = None
+        take.return_value = 5
+        self.assertRaises(
+            ratelimit.RateLimitTimeout, ratelimit.acquire, 'owner', 1)
+        self.assertEqual(1, take.call_count)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        metrics.flush()
+
+    def test_flush_aggregates(self):
+        metrics.inc('datadotworld_retries_total', endpoint='agg')
+        metrics.inc('datadotworld_retries_total', 2, endpoint='agg')
+        self.assertEqual(1, metrics.flush())
+        metrics.inc('datadotworld_retries_total', endpoint='agg')
+        metrics.flush()
+        self.assertIn(
+            'datadotworld_retries_total{endpoint="agg"} 4\n',
+            metrics.render())
+
+    @mock.patch('ckan.model.meta.engine')
+    def test_flush_fails_quietly(self, engine):
+        engine.connect.side_effect = OperationalError(
+            'connect', {}, Exception('pool timeout'))
+        metrics.inc('datadotworld_retries_total', endpoint='down')
+        self.assertEqual(0, metrics.flush())
+
+    @mock.patch(api.__name__ + '.release_retries')
+    @mock.patch(metrics.__name__ + '.observe')
+    @mock.patch(api.__name__ + '.notify')
+    def test_sync_seconds_only_for_syncs(self, notify, observe, release):
+        notify.return_value = False
+        with mock.patch(api.__name__ + '.load_config'):
+            api.syncronize('a', 'config.ini', enqueued=time.time())
+            api.syncronize_batch(['a'], 'config.ini', enqueued=time.time())
+        self.assertFalse(observe.called)
+
+        notify.return_value = True
+        with mock.patch(api.__name__ + '.load_config'):
+            api.syncronize('a', 'config.ini', enqueued=time.time())
+        self.assertEqual(1, observe.call_count)
+
+    def test_histogram(self):
+        metrics.observe(
+            'datadotworld_request_seconds', 0.3, endpoint='hist')
+        metrics.flush()
+        text = metrics.render()
+        self.assertIn('# TYPE datadotworld_request_seconds histogram', text)
+        for line in (
+                '_bucket{endpoint="hist",le="0.25"} 1',
+                '_bucket{endpoint="hist",le="0.5"} 1',
+                '_bucket{endpoint="hist",le="+Inf"} 1',
+                '_sum{endpoint="hist"} 0.3',
+                '_count{endpoint="hist"} 1'):
+            self.assertIn('datadotworld_request_seconds' + line, text)
+        self.assertNotIn(
+            'datadotworld_request_seconds_bucket{endpoint="hist",le="0.1"}',
+            text)
+        # buckets are ordered by bound, not alphabetically
+        self.assertLess(
+            text.index('le="5.0"}'), text.index('le="10.0"}'))
+
+    @mock.patch('requests.Session.put')
+    def test_send(self, put):
+        put.return_value = Response(429)
+        API('owner', 'key')._put('url', {'a': 1}, 'metrics-test')
+        metrics.flush()
+        text = metrics.render()
+        self.assertIn(
+            'datadotworld_requests_total'
+            '{endpoint="metrics-test",status="429"} 1', text)
+        self.assertIn(
+            'datadotworld_rate_limited_total{endpoint="metrics-test"} 1',
+            text)
+        self.assertIn(
+            'datadotworld_payload_bytes_sum{endpoint="metrics-test"} 8',
+            text)
+
+
+class TestCounters(TestCase):
+
+    def test_counters(self):
+        org = Organization()
+        other = Organization()
+        pkg = Dataset(owner_org=org['id'])
+        extras = Extras(
+            package_id=pkg['id'], owner='counter-owner', id=pkg['name'],
+            state=States.pending)
+        model.Session.add(extras)
+        model.Session.commit()
+        self.assertEqual(
+            {States.pending: 1}, counters.get_counts(org['id']))
+
+        extras.state = States.failed
+        model.Session.commit()
+        self.assertEqual(
+            {States.pending: 0, States.failed: 1},
+            counters.get_counts(org['id']))
+
+        model.Package.get(pkg['id']).owner_org = other['id']
+        model.Session.commit()
+        self.assertEqual(0, counters.get_counts(org['id'])[States.failed])
+        self.assertEqual(
+            {States.failed: 1}, counters.get_counts(other['id']))
+
+        model.Session.delete(extras)
+        model.Session.commit()
+        self.assertEqual(
+            {States.failed: 0}, counters.get_counts(other['id']))
+
+    def test_concurrent_changes(self):
+        org = Organization()
+        pkg = Dataset(owner_org=org['id'])
+        model.Session.add(Extras(
+            package_id=pkg['id'], owner='concurrent-owner', id=pkg['name'],
+            state=States.pending))
+        model.Session.commit()
+
+        make_session = sessionmaker(bind=model.meta.engine)
+        first, second = make_session(), make_session()
+        try:
+            first.query(Extras).get(pkg['id']).state = States.failed
+            first.flush()
+            second.query(Extras).get(pkg['id']).state = States.uptodate
+            # waits for the package lock held by the first session
+            thread = threading.Thread(target=second.commit)
+            thread.start()
+            time.sleep(0.5)
+            self.assertTrue(thread.is_alive())
+            first.commit()
+            thread.join(10)
+        finally:
+            first.close()
+            second.close()
+        self.assertEqual(
+            {States.pending: 0, States.failed: 0, States.uptodate: 1},
+            counters.get_counts(org['id']))
+
+    def test_recount(self):
+        org = Organization()
+        pkg = Dataset(owner_org=org['id'])
+        model.Session.add(Extras(
+            package_id=pkg['id'], owner='recount-owner', id=pkg['name'],
+            state=States.failed))
+        model.Session.commit()
+        # bulk changes are not tracked
+        model.Session.query(Extras).filter_by(package_id=pkg['id']).update(
+            {'state': States.uptodate}, synchronize_session=False)
+        model.Session.commit()
+        self.assertEqual({States.failed: 1}, counters.get_counts(org['id']))
+
+        counters.recount()
+        self.assertEqual(
+            {States.uptodate: 1}, counters.get_counts(org['id']))
+
+
+class TestCommand(TestCase):
+
+    def test_run_bulk(self):
+        finished = []
+
+        def finish(result):
+            finished.append(result)
+            return result != 4
+
+        jobs = [(i, lambda i=i: i * 2, finish) for i in range(5)]
+        stats = _run_bulk(jobs, 2)
+        self.assertEqual(5, stats['total'])
+        self.assertEqual(1, stats['errors'])
+        self.assertEqual([0, 2, 4, 6, 8], sorted(finished))
+
+    @mock.patch('ckan.model.Session.rollback')
+    def test_run_bulk_rolls_back(self, rollback):
+        def finish(result):
+            raise ValueError('commit failed')
+
+        stats = _run_bulk([(0, lambda: 0, finish)], 1)
+        self.assertEqual(1, stats['errors'])
+        self.assertTrue(rollback.called)
+
+    def test_sync_resources_queue(self):
+        org = Organization()
+        model.Session.add(Credentials(
+            organization_id=org['id'], integration=False,
+            owner='queue-owner', key='key'))
+        pkg = Dataset(owner_org=org['id'], resources=[
+            {'url': 'http://example.com/a.csv'},
+            {'url': 'http://example.com/b.csv'}])
+        model.Session.add(Extras(
+            package_id=pkg['id'], owner='queue-owner', id='queue-dataset'))
+        model.Session.commit()
+
+        queue = [
+            (client.owner, id)
+            for client, id in cmd._sync_resources_queue()
+            if client.owner == 'queue-owner']
+        self.assertEqual([('queue-owner', 'queue-dataset')], queue)
+
+    def test_bench_cleanup(self):
+        from ckanext.datadotworld import bench
+        org_id, ids = bench.create_packages(2, resources=1, tags=1)
+        for id in ids:
+            model.Session.add(Extras(
+                package_id=id, owner='bench-owner', id=id,
+                state=States.failed))
+            model.Session.add(SyncLog(
+                package_id=id, action='create', status=500))
+        model.Session.commit()
+        self.assertEqual({States.failed: 2}, counters.get_counts(org_id))
+
+        bench.cleanup(org_id, ids)
+        self.assertEqual({}, counters.get_counts(org_id))
+        self.assertEqual(0, model.Session.query(SyncLog).filter(
+            SyncLog.package_id.in_(ids)).count())
+
+    def test_upgrade_creates_indexes(self):
+        inspector = inspect(model.meta.engine)
+        names = set(
+            index['name']
+            for index in inspector.get_indexes('datadotworld_extras'))
+        for name in (
+                'ix_datadotworld_extras_state',
+                'ix_datadotworld_extras_owner_id',
+                'ix_datadotworld_extras_owner_state'):
+            self.assertIn(name, names)
+
+    def test_sync_lag_report(self):
+        org = Organization()
+        now = datetime.datetime.utcnow()
+        second = datetime.timedelta(seconds=1)
+        for enqueued, finished in (
+                (now - 10 * second, now - 8 * second),
+                (now - 10 * second, now - 7 * second),
+                (now - 10 * second, now - 6 * second),
+                (now - 3 * second, now - 4 * second),
+                (now - 3 * second, None)):
+            pkg = Dataset(owner_org=org['id'])
+            model.Session.add(Extras(
+                package_id=pkg['id'], owner='lag-owner', id=pkg['name'],
+                enqueued_at=enqueued, finished_at=finished))
+        model.Session.commit()
+
+        report = [
+            item for item in cmd._sync_lag_report()
+            if item['org'] == org['name']]
+        self.assertEqual(1, len(report))
+        self.assertEqual(3, report[0]['synced'])
+        self.assertEqual(3, report[0]['p50'])
+        self.assertEqual(4, report[0]['p99'])
+        self.assertEqual(2, report[0]['pending'])
+        self.assertGreaterEqual(report[0]['oldest_pending'], 3)
+
+
+class TestController(TestCase):
+
+    def test_metrics_allowed(self):
+        module = 'ckanext.datadotworld.controller.datadotworld'
+        request = mock.Mock(headers={'Authorization': u'Bearer secret'})
+        with mock.patch(module + '.c', userobj=None), \
+                mock.patch(module + '.request', request), \
+                mock.patch(module + '.config', {}) as config:
+            from ckanext.datadotworld.controller.datadotworld import (
+                _metrics_allowed)
+            self.assertFalse(_metrics_allowed())
+            config['ckan.datadotworld.metrics_token'] = 'secret'
+            self.assertTrue(_metrics_allowed())
+            config['ckan.datadotworld.metrics_token'] = 'other'
+            self.assertFalse(_metrics_allowed())
+            request.headers = {}
+            self.assertFalse(_metrics_allowed())
+
+    def test_list_sync_page(self):
+        org = Organization()
+        names = []
+        for i, message in enumerate(['a 100%', 'b', 'c 100_']):
+            pkg = Dataset(owner_org=org['id'], name='list-sync-{0}'.format(i))
+            names.append(pkg['name'])
+            model.Session.add(Extras(
+                package_id=pkg['id'], owner='list-owner', id=pkg['name'],
+                state=States.failed, message=dumps({'message': message})))
+        model.Session.commit()
+        group = model.Group.get(org['id'])
+        page = DataDotWorldController()._list_sync_page
+
+        rows, after = page(States.failed, [group.id], None, None, '', 2)
+        self.assertEqual(names[:2], [row.name for row in rows])
+        self.assertEqual(names[1], after)
+        rows, after = page(States.failed, [group.id], group, after, '', 2)
+        self.assertEqual(names[2:], [row.name for row in rows])
+        self.assertEqual(None, after)
+
+        rows, after = page(States.failed, [group.id], None, None, '100%', 2)
+        self.assertEqual(names[:1], [row.name for row in rows])
+        rows, after = page(States.uptodate, [group.id], None, None, '', 2)
+        self.assertEqual([], rows)
+
+    def test_list_sync_unknown_org(self):
+        module = 'ckanext.datadotworld.controller.datadotworld'
+        request = mock.Mock(params={'org': 'missing-org'})
+        with mock.patch(module + '.c', user='someone'), \
+                mock.patch(module + '.request', request), \
+                mock.patch(module + '.base.abort') as abort, \
+                mock.patch(dh.__name__ + '.admin_org_ids',
+                           return_value=('org-id',)):
+            abort.side_effect = ValueError('aborted')
+            self.assertRaises(
+                ValueError, DataDotWorldController().list_sync,
+                States.failed)
+        self.assertEqual(404, abort.call_args[0][0])
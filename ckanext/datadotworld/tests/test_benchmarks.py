@@ -0,0 +1,176 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks for payload-building functions.
+
+Skipped unless DATADOTWORLD_BENCH environment variable is set::
+
+    DATADOTWORLD_BENCH=1 nosetests --ckan --nologcapture \
+        --with-pylons=test.ini ckanext/datadotworld/tests/test_benchmarks.py
+
+Timings are divided by the duration of fixed calibration workload, so
+results are comparable between runs on machines of different speed. Use
+DATADOTWORLD_BENCH=save to store current results as baseline
+(bench_baseline.json next to this file). When baseline exists, benchmark
+fails if time or size of result of any case exceeds baseline by more than
+DATADOTWORLD_BENCH_TOLERANCE(0.25 by default).
+"""
+import os
+import sys
+import gc
+import json
+import timeit
+import os.path as path
+from unittest import TestCase, skipUnless
+
+import ckanext.datadotworld.api as api
+
+MODE = os.environ.get('DATADOTWORLD_BENCH')
+TOLERANCE = float(os.environ.get('DATADOTWORLD_BENCH_TOLERANCE', 0.25))
+BASELINE = path.join(path.dirname(__file__), 'bench_baseline.json')
+SIZES = (10, 100, 1000, 5000)
+REPEAT = 5
+
+
+def make_package(size):
+    """Generate package dict with `size` tags and resources.
+    """
+    tags = []
+    for i in range(size):
+        # mix of valid, duplicated, too long and non-alphanumeric tags
+        tags.append({'name': u'Tag_{0}'.format(i % (size // 2 or 1))})
+        if i % 10 == 0:
+            tags.append({'name': u'x' * 30})
+            tags.append({'name': u'\u0442\u0435\u0433 {0}'.format(i)})
+    resources = [{
+        'url': 'http://example.com/data/{0}/file.csv?x=1#top'.format(i),
+        'name': u'Resource {0}'.format(i),
+        'format': 'CSV' if i % 2 else '',
+        'description': u'Resource description ' * (i % 10),
+    } for i in range(size)]
+    return {
+        'id': 'bench-package',
+        'name': 'bench-package',
+        'title': u'  Benchmark _ package -- {0}  '.format(size) * 3,
+        'notes': u'Notes ' * size,
+        'license_id': 'cc-by',
+        'private': False,
+        'metadata_modified': '2017-01-01T00:00:00.000000',
+        'tags': tags,
+        'resources': resources,
+    }
+
+
+def deep_size(obj, seen=None):
+    """Approximate memory used by object and everything it references.
+    """
+    seen = seen if seen is not None else set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
+
+
+def _calibration():
+    total = 0
+    for i in range(20000):
+        total += len(str(i).replace('1', '-').split('-'))
+    return total
+
+
+def measure(fn, number):
+    """Best time of single call out of REPEAT runs, in calibration units.
+    """
+    gc.collect()
+    timer = timeit.Timer(fn)
+    best = min(timer.repeat(REPEAT, number)) / number
+    calibration = min(timeit.Timer(_calibration).repeat(REPEAT, 1))
+    return best / calibration
+
+
+class TestBenchmarks(TestCase):
+    results = {}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.client = api.API('owner', 'key')
+        cls.packages = dict((size, make_package(size)) for size in SIZES)
+
+    @classmethod
+    def tearDownClass(cls):
+        if not cls.results:
+            return
+        for name in sorted(cls.results):
+            print('{0:45} time={1[time]:10.4f} memory={1[memory]:>10}'.format(
+                name, cls.results[name]))
+        if MODE == 'save':
+            with open(BASELINE, 'w') as f:
+                json.dump(cls.results, f, indent=2, sort_keys=True)
+
+    def _run(self, name, fn):
+        failures = []
+        baseline = {}
+        if MODE != 'save' and path.exists(BASELINE):
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        for size in SIZES:
+            pkg = self.packages[size]
+            case = '{0}[{1}]'.format(name, size)
+            number = max(1, 1000 // size)
+            result = {
+                'time': measure(lambda: fn(pkg), number),
+                'memory': deep_size(fn(pkg)),
+            }
+            self.results[case] = result
+            expected = baseline.get(case)
+            if not expected:
+                continue
+            for metric in ('time', 'memory'):
+                if result[metric] > expected[metric] * (1 + TOLERANCE):
+                    failures.append('{0} {1}: {2:.4f} > {3:.4f}'.format(
+                        case, metric, result[metric], expected[metric]))
+        if failures:
+            self.fail('Worse than baseline: ' + '; '.join(failures))
+
+    @skipUnless(MODE, 'DATADOTWORLD_BENCH is not set')
+    def test_tags_name_normalize(self):
+        self._run(
+            'datadotworld_tags_name_normalize',
+            lambda pkg: api.datadotworld_tags_name_normalize(pkg['tags']))
+
+    @skipUnless(MODE, 'DATADOTWORLD_BENCH is not set')
+    def test_prepare_resource_url(self):
+        self._run(
+            '_prepare_resource_url',
+            lambda pkg: [
+                api._prepare_resource_url(res) for res in pkg['resources']])
+
+    @skipUnless(MODE, 'DATADOTWORLD_BENCH is not set')
+    def test_dataworld_name(self):
+        self._run(
+            'dataworld_name', lambda pkg: api.dataworld_name(pkg['title']))
+
+    @skipUnless(MODE, 'DATADOTWORLD_BENCH is not set')
+    def test_dataset_footnote(self):
+        self._run('dataset_footnote', api.dataset_footnote)
+
+    @skipUnless(MODE, 'DATADOTWORLD_BENCH is not set')
+    def test_format_data(self):
+        self._run('_format_data', self.client._format_data)
@@ -0,0 +1,68 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Import budget of the plugin module.
+
+Web processes import the plugin on startup, so it must not pull in the
+sync stack. Import happens in a fresh interpreter, after CKAN modules
+that are loaded anyway, so only the cost of the extension is measured.
+"""
+import sys
+import json
+import subprocess
+from unittest import TestCase
+
+# modules that must be loaded only by workers and commands
+FORBIDDEN = (
+    'requests',
+    'celery',
+    'bleach',
+    'markdown',
+    'ckanext.datadotworld.api',
+    'ckanext.datadotworld.tasks',
+    'ckanext.datadotworld.ratelimit',
+)
+MAX_NEW_MODULES = 20
+MAX_SECONDS = 0.5
+
+SCRIPT = '''
+import sys, json, time
+import ckan.model, ckan.plugins, ckan.plugins.toolkit, pylons
+before = set(sys.modules)
+started = time.time()
+import ckanext.datadotworld.plugin
+elapsed = time.time() - started
+new = [name for name in set(sys.modules) - before
+       if sys.modules[name] is not None]
+print(json.dumps({'elapsed': elapsed, 'new': sorted(new)}))
+'''
+
+
+class TestImports(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        out = subprocess.check_output([sys.executable, '-c', SCRIPT])
+        cls.report = json.loads(out.strip().splitlines()[-1])
+
+    def test_sync_stack_not_loaded(self):
+        new = set(self.report['new'])
+        for name in FORBIDDEN:
+            self.assertNotIn(name, new)
+
+    def test_new_modules_budget(self):
+        self.assertLessEqual(
+            len(self.report['new']), MAX_NEW_MODULES, self.report['new'])
+
+    def test_import_time_budget(self):
+        self.assertLessEqual(self.report['elapsed'], MAX_SECONDS)
@@ -0,0 +1,36 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import Table, Column, Integer, DateTime, Index, MetaData
+from migrate.changeset import create_column, drop_column
+
+
+def upgrade(migrate_engine):
+    metadata = MetaData(bind=migrate_engine)
+    extras = Table('datadotworld_extras', metadata, autoload=True)
+    create_column(Column('attempt', Integer(), default=0), extras)
+    create_column(Column('next_attempt', DateTime()), extras)
+    Index(
+        'ix_datadotworld_extras_next_attempt', extras.c.next_attempt
+    ).create()
+
+
+def downgrade(migrate_engine):
+    metadata = MetaData(bind=migrate_engine)
+    extras = Table('datadotworld_extras', metadata, autoload=True)
+    Index(
+        'ix_datadotworld_extras_next_attempt', extras.c.next_attempt
+    ).drop()
+    drop_column('next_attempt', extras)
+    drop_column('attempt', extras)
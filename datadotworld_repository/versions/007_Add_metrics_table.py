@@ -0,0 +1,34 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import Table, Column, UnicodeText, Float, MetaData
+metadata = MetaData()
+
+
+metrics = Table(
+    'datadotworld_metrics', metadata,
+    Column('name', UnicodeText(), primary_key=True, nullable=False),
+    Column('labels', UnicodeText(), primary_key=True, nullable=False),
+    Column('value', Float(), nullable=False)
+)
+
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    metrics.create()
+
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    metrics.drop()
@@ -0,0 +1,43 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import (
+    Table, Column, Integer, UnicodeText, Float, DateTime, Index, MetaData)
+metadata = MetaData()
+
+
+sync_log = Table(
+    'datadotworld_sync_log', metadata,
+    Column('id', Integer(), primary_key=True, nullable=False),
+    Column('package_id', UnicodeText(), nullable=False),
+    Column('created', DateTime(), nullable=False),
+    Column('action', UnicodeText(), nullable=False),
+    Column('status', Integer()),
+    Column('duration', Float()),
+    Column('message', UnicodeText())
+)
+Index(
+    'ix_datadotworld_sync_log_package_created',
+    sync_log.c.package_id, sync_log.c.created)
+Index('ix_datadotworld_sync_log_created', sync_log.c.created)
+
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    sync_log.create()
+
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    sync_log.drop()
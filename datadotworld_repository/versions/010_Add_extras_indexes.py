@@ -0,0 +1,74 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Indexes for state and remote id lookups on datadotworld_extras.
+
+On PostgreSQL indexes are built with CREATE INDEX CONCURRENTLY, so
+`paster datadotworld upgrade` does not block syncs and package edits on
+a live database. Concurrent build cannot run inside transaction, so
+separate autocommit connection is used. Index left invalid by an
+interrupted concurrent build is dropped and built again.
+"""
+
+from sqlalchemy import Table, Index, MetaData, text
+
+INDEXES = (
+    ('ix_datadotworld_extras_state', ('state',)),
+    ('ix_datadotworld_extras_owner_id', ('owner', 'id')),
+    ('ix_datadotworld_extras_owner_state', ('owner', 'state')),
+)
+
+
+def _is_postgres(migrate_engine):
+    return migrate_engine.dialect.name == 'postgresql'
+
+
+def _index_validity(conn, name):
+    row = conn.execute(text(
+        'SELECT i.indisvalid FROM pg_class c '
+        'JOIN pg_index i ON i.indexrelid = c.oid '
+        'WHERE c.relname = :name'), name=name).first()
+    return None if row is None else row[0]
+
+
+def upgrade(migrate_engine):
+    if not _is_postgres(migrate_engine):
+        metadata = MetaData(bind=migrate_engine)
+        extras = Table('datadotworld_extras', metadata, autoload=True)
+        for name, columns in INDEXES:
+            Index(name, *[extras.c[column] for column in columns]).create()
+        return
+
+    conn = migrate_engine.connect().execution_options(
+        isolation_level='AUTOCOMMIT')
+    try:
+        for name, columns in INDEXES:
+            valid = _index_validity(conn, name)
+            if valid:
+                continue
+            if valid is not None:
+                conn.execute('DROP INDEX CONCURRENTLY {0}'.format(name))
+            conn.execute(
+                'CREATE INDEX CONCURRENTLY {0} '
+                'ON datadotworld_extras ({1})'.format(
+                    name, ', '.join(columns)))
+    finally:
+        conn.close()
+
+
+def downgrade(migrate_engine):
+    metadata = MetaData(bind=migrate_engine)
+    extras = Table('datadotworld_extras', metadata, autoload=True)
+    for name, columns in reversed(INDEXES):
+        Index(name, *[extras.c[column] for column in columns]).drop()
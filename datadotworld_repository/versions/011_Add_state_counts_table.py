@@ -0,0 +1,45 @@
+# Copyright 2017 data.world, inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from sqlalchemy import Table, Column, UnicodeText, Integer, MetaData
+metadata = MetaData()
+
+
+state_counts = Table(
+    'datadotworld_state_counts', metadata,
+    Column('organization_id', UnicodeText(), primary_key=True, nullable=False),
+    Column('state', UnicodeText(), primary_key=True, nullable=False),
+    Column('amount', Integer(), nullable=False)
+)
+
+FILL = '''
+INSERT INTO datadotworld_state_counts (organization_id, state, amount)
+SELECT package.owner_org, datadotworld_extras.state, count(*)
+FROM datadotworld_extras
+JOIN package ON package.id = datadotworld_extras.package_id
+WHERE package.owner_org IS NOT NULL
+  AND datadotworld_extras.state IS NOT NULL
+GROUP BY package.owner_org, datadotworld_extras.state
+'''
+
+
+def upgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    state_counts.create()
+    migrate_engine.execute(FILL)
+
+
+def downgrade(migrate_engine):
+    metadata.bind = migrate_engine
+    state_counts.drop()